@@ -0,0 +1,68 @@
+'''
+Compare the columnar BWResults._expand against the recursive, dict-per-row
+flattener that it replaced, on synthetic nested results.
+
+    python -m benchmarks.bench_expand
+'''
+import time
+import tracemalloc
+
+import pandas as pd
+
+from bwypy.core import BWResults
+
+
+def legacy_expand(o, grouplist, counttypes, collector=[]):
+    ''' The previous recursive flattener, kept here as the baseline. '''
+    if len(grouplist) == 0:
+        l = []
+        for i, val in enumerate(o):
+            l += [(counttypes[i], val)]
+        return [dict(collector + l)]
+    else:
+        l = []
+        for k, v in o.items():
+            new_coll = collector + [(grouplist[0], k)]
+            l += legacy_expand(v, grouplist[1:], counttypes, new_coll)
+        return l
+
+
+def nested(cardinalities, ncounts=2):
+    ''' Build a nested result with the given number of values per level. '''
+    if len(cardinalities) == 0:
+        return list(range(ncounts))
+    return {"v%d" % i: nested(cardinalities[1:], ncounts)
+            for i in range(cardinalities[0])}
+
+
+def measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    counttypes = ['TextCount', 'WordCount']
+    print("%-18s %10s %12s %12s %12s %12s" % ("shape", "rows", "legacy s",
+          "columnar s", "legacy MB", "columnar MB"))
+    for shape in [(100, 10), (130, 50, 20), (130, 50, 20, 10)]:
+        groups = ['g%d' % i for i in range(len(shape))]
+        results = BWResults(nested(shape), {'groups': groups,
+                                            'counttype': counttypes})
+        legacy = lambda: pd.DataFrame(legacy_expand(results._json, groups, counttypes))
+        columnar = lambda: pd.DataFrame(results._expand(results._json, groups, counttypes))
+        lt, lm = measure(legacy)
+        ct, cm = measure(columnar)
+        rows = 1
+        for n in shape:
+            rows *= n
+        print("%-18s %10d %12.3f %12.3f %12.1f %12.1f" % (
+              "x".join(map(str, shape)), rows, lt, ct, lm / 1e6, cm / 1e6))
+
+
+if __name__ == '__main__':
+    main()
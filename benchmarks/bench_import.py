@@ -0,0 +1,60 @@
+'''
+Time a cold start: importing bwypy in a fresh interpreter, then running a
+small query against a local mock Bookworm server and reading its JSON, as
+a short-lived script would.
+
+    python -m benchmarks.bench_import
+    python -m benchmarks.bench_import --repeat 20
+
+For comparison, it also times the same script after importing pandas up
+front, which is what every start used to cost.
+'''
+import argparse
+import statistics
+import subprocess
+import sys
+
+from benchmarks.mockserver import MockBookworm
+
+SCRIPT = '''
+import time
+start = time.perf_counter()
+%(preload)s
+import bwypy
+imported = time.perf_counter()
+bw = bwypy.BWQuery(endpoint=%(endpoint)r, database='mock')
+bw.groups = ['date_year']
+bw.run().json()
+done = time.perf_counter()
+print(imported - start, done - start)
+'''
+
+
+def cold_start(endpoint, preload):
+    ''' Run the script in a new interpreter, returning its two timings. '''
+    code = SCRIPT % {'endpoint': endpoint, 'preload': preload}
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return [float(t) for t in out.split()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    server = MockBookworm(cardinality=10)
+    endpoint = server.start()
+    try:
+        print("%-22s %14s %14s" % ("script", "import ms", "with query ms"))
+        for name, preload in [('bwypy', ''),
+                              ('pandas, then bwypy', 'import pandas, numpy')]:
+            runs = [cold_start(endpoint, preload) for i in range(args.repeat)]
+            imported = statistics.median(r[0] for r in runs)
+            done = statistics.median(r[1] for r in runs)
+            print("%-22s %14.1f %14.1f" % (name, imported * 1000, done * 1000))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+'''
+A local stand-in for a Bookworm server, answering `returnPossibleFields` and
+`data` queries with synthetic results, for benchmarking without a network.
+
+    server = MockBookworm(cardinality=20, latency=0.05)
+    endpoint = server.start()
+    bw = bwypy.BWQuery(endpoint=endpoint, database='mock')
+    ...
+    server.stop()
+
+It can also be run on its own, to point other clients at:
+
+    python -m benchmarks.mockserver --port 8080 --cardinality 50
+'''
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class MockBookworm:
+    '''
+    cardinality: Number of distinct values for each field.
+    nfields: Number of character fields, named field0, field1, ..., in
+        addition to the integer field date_year.
+    latency: Seconds to wait before answering each request.
+    '''
+
+    def __init__(self, cardinality=10, nfields=4, latency=0, seed=0):
+        self.cardinality = cardinality
+        self.latency = latency
+        self.seed = seed
+        self.requests = 0
+        self.values = {'date_year': [str(1800 + i) for i in range(cardinality)]}
+        for i in range(nfields):
+            self.values['field%d' % i] = ['value%d' % j for j in range(cardinality)]
+        self.fields = [{'name': name, 'dbname': name, 'anchor': 'bookid',
+                        'description': '', 'tablename': name + 'Lookup',
+                        'type': 'integer' if name == 'date_year' else 'character'}
+                       for name in self.values]
+        self._bodies = {}
+        self._server = None
+
+    def start(self, port=0):
+        ''' Serve in a background thread, returning the endpoint URL. '''
+        handler = type('Handler', (_Handler,), {'mock': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.endpoint
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:%d/cgi-bin/dbbindings.py' % self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def respond(self, query):
+        ''' Return the encoded response body for a query. '''
+        self.requests += 1
+        key = json.dumps(query, sort_keys=True)
+        if key not in self._bodies:
+            if query.get('method') == 'returnPossibleFields':
+                body = self.fields
+            else:
+                body = {'status': 'success', 'data': self.results(query)}
+            self._bodies[key] = json.dumps(body).encode('utf-8')
+        return self._bodies[key]
+
+    def results(self, query):
+        groups = query.get('groups', [])
+        groups = groups if type(groups) is list else [groups]
+        counttypes = query.get('counttype', ['TextCount', 'WordCount'])
+        counttypes = counttypes if type(counttypes) is list else [counttypes]
+        limits = query.get('search_limits', {})
+        rng = random.Random(self.seed)
+        levels = [self._limited_values(g.lstrip('*'), limits) for g in groups]
+
+        def build(depth):
+            if depth == len(levels):
+                return [rng.randint(0, 100000) if c in ('TextCount', 'WordCount')
+                        else rng.random() * 100 for c in counttypes]
+            return {v: build(depth + 1) for v in levels[depth]}
+        return build(0)
+
+    def _limited_values(self, field, limits):
+        values = self.values.get(field.replace('__id', ''), [])
+        if field.endswith('__id'):
+            values = [str(i) for i in range(len(values))]
+        ids = limits.get(field + '__id')
+        if type(ids) is dict:
+            values = [v for i, v in enumerate(values) if _in_range(i, ids)]
+        limit = limits.get(field)
+        if type(limit) is list:
+            values = [v for v in values if v in limit]
+        elif type(limit) is dict:
+            values = [v for v in values if _in_range(int(v), limit)]
+        return values
+
+
+def _in_range(value, limit):
+    return (value >= limit.get('$gte', float('-inf')) and
+            value > limit.get('$gt', float('-inf')) and
+            value < limit.get('$lt', float('inf')) and
+            value <= limit.get('$lte', float('inf')))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    mock = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        self._answer(params)
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            raw = gzip.decompress(raw)
+        self._answer(parse_qs(raw.decode('utf-8')))
+
+    def _answer(self, params):
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+        body = self.mock.respond(json.loads(params['queryTerms'][0]))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--cardinality', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0)
+    args = parser.parse_args()
+    server = MockBookworm(cardinality=args.cardinality, latency=args.latency)
+    server.start(args.port)
+    print("Serving on %s" % server.endpoint)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''
+Time and measure the memory of the main bwypy code paths against a local
+mock Bookworm server, at several result sizes.
+
+    python -m benchmarks.run
+    python -m benchmarks.run --depth 3 --cardinality 10 50 100 --latency 0.02
+
+Each result size is cardinality ** depth rows. Times are the median of
+--repeat runs; peak memory is measured in a separate run with tracemalloc.
+'''
+import argparse
+import io
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import bwypy
+from benchmarks.mockserver import MockBookworm
+
+
+def measure(func, repeat):
+    ''' Return the median seconds and the peak traced bytes for func. '''
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(times), peak
+
+
+def cases(endpoint, groups, tmpdir):
+    '''
+    Yield (name, function) pairs for each code path. Each function does its
+    own setup where the path would otherwise hit a cache.
+    '''
+    registry = bwypy.FieldRegistry()
+
+    def init():
+        registry.invalidate()
+        with bwypy.set_options(field_registry=registry):
+            return bwypy.BWQuery(endpoint=endpoint, database='mock')
+
+    bw = init()
+    bw.groups = groups
+    results = bw.run()
+
+    def frame():
+        results.clear_cache()
+        return results.frame()
+
+    yield 'BWQuery.__init__', init
+    yield '_validate', bw._validate
+    yield '_fetch', lambda: bw._fetch(bw.json)
+    yield 'BWResults._expand', lambda: results._expand(results._json, results.groups,
+                                                      results.counttype)
+    yield 'frame', frame
+    yield 'csv', lambda: (results.clear_cache(), results.csv())
+    yield 'to_csv', lambda: results.to_csv(io.StringIO())
+    try:
+        import pyarrow
+    except ImportError:
+        return
+    path = os.path.join(tmpdir, 'results.parquet')
+    yield 'to_parquet', lambda: results.to_parquet(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--depth', type=int, default=2,
+                        help="Number of groups in each query.")
+    parser.add_argument('--cardinality', type=int, nargs='+', default=[10, 100, 300],
+                        help="Values per group; one benchmark for each.")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Seconds that the mock server waits per request.")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("%-18s %10s %12s %12s" % ("path", "rows", "seconds", "peak MB"))
+    for cardinality in args.cardinality:
+        server = MockBookworm(cardinality=cardinality, nfields=args.depth,
+                              latency=args.latency)
+        endpoint = server.start()
+        groups = ['field%d' % i for i in range(args.depth)]
+        rows = cardinality ** args.depth
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name, func in cases(endpoint, groups, tmpdir):
+                seconds, peak = measure(func, args.repeat)
+                print("%-18s %10d %12.4f %12.1f" % (name, rows, seconds, peak / 1e6))
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
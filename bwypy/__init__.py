@@ -1 +1,9 @@
-from bwypy.core import *
\ No newline at end of file
+from bwypy.core import *
+
+
+def __getattr__(name):
+    # Imported on first use, since aiohttp is slow to import
+    if name == 'AsyncBWQuery':
+        from bwypy.aio import AsyncBWQuery
+        return AsyncBWQuery
+    raise AttributeError("module 'bwypy' has no attribute %r" % name)
@@ -0,0 +1,424 @@
+try:
+    import ujson as jsonlib
+except:
+    import json as jsonlib
+import asyncio
+import logging
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from bwypy.core import (BWQuery, BWResults, _globals, _with_ratios, _fill_range,
+                        _shard_step, _empty_refresh, _RowParser, _import_ijson)
+from bwypy.cache import canonical_query
+from bwypy.transport import EndpointPool, encode_query
+from bwypy.instrument import Timer
+
+# Downloads in progress, by event loop and query
+_in_flight = {}
+
+
+class AsyncBWQuery(BWQuery):
+    '''
+    A BWQuery for asyncio code. Queries are built and validated the same way,
+    but `run`, `fields`, `field_values` and `run_many` are coroutines:
+
+        bw = AsyncBWQuery(json=jsonq, endpoint=endpoint)
+        results = await bw.run()
+
+    Since fields can't be fetched from the constructor, they are fetched on
+    the first `run()` when verify_fields is on. Await `fields()` first for
+    validation to apply to the property setters.
+
+    `iter_rows` is an async generator, used with `async for`.
+
+    session: An aiohttp.ClientSession to share between queries. If None, one
+        is created on first use and closed by `close()`.
+    semaphore: An asyncio.Semaphore to share between queries, bounding the
+        number of requests in flight. If None, one is created with
+        max_concurrency slots.
+    '''
+
+    def __init__(self, json=None, endpoint=None, database=None, verify_fields=True, verify_cert=True,
+                 session=None, semaphore=None, max_concurrency=100):
+        if aiohttp is None:
+            raise ImportError("AsyncBWQuery requires aiohttp. Install it with "
+                              "`pip install aiohttp`.")
+        self._verify_fields = verify_fields
+        self._session = session
+        self._owns_session = session is None
+        self._parent = None
+        self._max_concurrency = max_concurrency
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(max_concurrency)
+        self._semaphore = semaphore
+        BWQuery.__init__(self, json=json, endpoint=endpoint, database=database,
+                         verify_fields=False, verify_cert=verify_cert)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    async def close(self):
+        ''' Close the aiohttp session, if this query created it. '''
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def fields(self):
+        '''
+        Return Pandas object with all the fields in a Bookworm
+        '''
+        await self._load_fields()
+        return self._field_frame()
+
+    async def _load_fields(self):
+        if self._fields is None:
+            key = self._registry_key('fields')
+            obj = self.registry.lookup(key)
+            if obj is None:
+                obj = await self._fetch(self._fields_query())
+                self.registry.set(key, obj)
+            self._set_fields(obj)
+
+    async def run(self, stream=False, local_ratios=None):
+        ''' Run the query. See BWQuery.run for stream and local_ratios. '''
+        if local_ratios is None:
+            local_ratios = _globals.get('local_ratios')
+        local_ratios = local_ratios and len(self._ratio_counttypes()) > 0
+        if stream:
+            if local_ratios:
+                raise ValueError("local_ratios can't be computed for streamed results")
+            rows = [row async for row in self.iter_rows()]
+            return BWResults.from_rows(rows, self.json, self._dtypes)
+
+        if self._verify_fields and self._fields is None:
+            await self._load_fields()
+        self._validate()
+        self._runtime_validate()
+
+        if local_ratios:
+            base = self._base_counts_query()
+            denominator = self._denominator_query()
+            key = self._registry_key('denominators', canonical_query(denominator))
+            denominators = self.registry.lookup(key)
+            if denominators is None:
+                denominators = (await self._fetch(denominator))['data']
+                self.registry.set(key, denominators)
+            logging.debug("Running " + jsonlib.dumps(base))
+            json_response = await self._fetch(base)
+            return _with_ratios(json_response['data'], base, denominators,
+                                self.json, self._dtypes)
+
+        logging.debug("Running " + jsonlib.dumps(self.json))
+        json_response = await self._fetch(self.json)
+
+        return BWResults(json_response['data'], self.json, self._dtypes)
+
+    async def iter_rows(self):
+        '''
+        Run the query, yielding a `(group values, counts)` pair for each row
+        as the response is parsed. See BWQuery.iter_rows. Requires ijson.
+        '''
+        if self._verify_fields and self._fields is None:
+            await self._load_fields()
+        self._validate()
+        self._runtime_validate()
+
+        timer = Timer()
+        key, response = self._from_cache(self.json)
+        if response is not None:
+            timer.lap('cache')
+            self._emit_fetch(self.json, timer, cache='hit')
+            for row in BWResults(response['data'], self.json)._iter_leaves():
+                yield row
+            return
+
+        ijson = _import_ijson()
+        logging.debug("Streaming " + jsonlib.dumps(self.json))
+        groups = self.json['groups']
+        parser = _RowParser(len(groups) if type(groups) is list else 1)
+        terms = jsonlib.dumps(self.json)
+        timer.lap('encode')
+        rows = 0
+        async with self._semaphore:
+            timer.lap('queue')
+            r = await self._send(terms, timer, stream=True)
+            async with r:
+                events = ijson.basic_parse_async(r.content, use_float=True)
+                async for event, value in events:
+                    row = parser.feed(event, value)
+                    if row is not None:
+                        rows += 1
+                        yield row
+        parser.close()
+        # Includes the time spent by the consumer of the rows
+        timer.lap('stream')
+        logging.debug("Query time: %.3fs" % timer.total())
+        self._emit_fetch(self.json, timer, rows=rows)
+
+    async def run_many(self, queries):
+        '''
+        Run several queries concurrently, returning their BWResults in the
+        same order as `queries`. See BWQuery.run_many. Concurrency is bounded
+        by the semaphore rather than a number of workers.
+        '''
+        await self._prepare_derived()
+        return await asyncio.gather(*[self._run_derived(q) for q in queries],
+                                    return_exceptions=True)
+
+    async def iter_many(self, queries):
+        '''
+        Like `run_many`, but yield `(index, result)` pairs as each query
+        completes.
+        '''
+        async def indexed(i, q):
+            try:
+                return i, await self._run_derived(q)
+            except Exception as e:
+                return i, e
+
+        await self._prepare_derived()
+        for future in asyncio.as_completed([indexed(i, q) for i, q in enumerate(queries)]):
+            yield await future
+
+    async def run_sharded(self, field, step=None, values=None, target_rows=None,
+                          target_seconds=None, max_workers=8):
+        '''
+        Run the query as several smaller queries, split along the search
+        limits for one field, and merge them. See BWQuery.run_sharded. The
+        shards run concurrently, bounded by the semaphore; max_workers only
+        sizes them when no step or target is given.
+        '''
+        await self._prepare_derived()
+        groups, counttypes = self._sharding(field)
+        lo = None
+        if values is None and self._is_range_field(field):
+            lo, hi = await self._field_range(field)
+            size = hi - lo
+        else:
+            if values is None:
+                values = self._limit_values(field)
+            if values is None:
+                values = await self.field_values(field)
+            size = len(values)
+        shard = lambda start, stop: self._shard(field, start, stop, lo, size, values)
+
+        merged = None
+        done = 0
+        if step is None and (target_rows or target_seconds):
+            # Measure a small first shard to size the rest
+            done = max(1, size // (max_workers * 4))
+            start = time.time()
+            merged = (await self._derive(shard(0, done)).run()).json()
+            step = _shard_step(done, merged, time.time() - start, len(groups),
+                               target_rows, target_seconds)
+        elif step is None:
+            step = max(1, -(-size // max_workers))
+
+        shards = [shard(i, i + step) for i in range(done, size, step)]
+        logging.debug("Running %d shards of %s" % (len(shards), field))
+        results = await self.run_many(shards)
+        return self._merge_shards(merged, results, groups, counttypes)
+
+    async def refresh(self, start, stop=None, field='date_year', previous=None):
+        '''
+        Update earlier results of this query by running it again only for
+        values of an integer field in [start, stop). See BWQuery.refresh.
+        '''
+        await self._prepare_derived()
+        key, previous = self._refresh_previous(field, previous)
+        if previous is None:
+            return await self.run()
+        values = self._limit_values(field)
+        if values is None:
+            lo, hi = await self._field_range(field)
+            start = max(start, lo)
+            stop = hi if stop is None else min(stop, hi)
+        if _empty_refresh(start, stop, values):
+            return previous
+        delta = (await self._refresh_query(field, start, stop, values).run()).json()
+        return self._refresh_splice(key, previous, delta, field, start, stop)
+
+    async def _field_range(self, field):
+        lo, hi = self._limit_range(field)
+        if lo is None or hi is None:
+            return _fill_range(lo, hi, await self.field_values(field))
+        return int(lo), int(hi)
+
+    async def _prepare_derived(self):
+        # Set up what derived queries share, so that they don't each do it
+        if self._verify_fields and self._fields is None:
+            await self._load_fields()
+        self._get_session()
+
+    def _variant(self, changes):
+        # Variants use their parent's session, even if it isn't open yet
+        bw = BWQuery._variant(self, changes)
+        bw._owns_session = False
+        if self._session is None:
+            bw._parent = self
+        return bw
+
+    async def _run_derived(self, query):
+        if isinstance(query, BWQuery):
+            return await query.run()
+        return await self._derive(query).run()
+
+    async def field_values(self, field, max=None, top=None):
+        ''' Return all possible values for a field. See BWQuery.field_values. '''
+        cache_key = field if max is None and top is None else (field, max, top)
+        if cache_key not in self._field_cache:
+            key = self._registry_key('values', field, max, top)
+            values = self.registry.lookup(key)
+            if values is None:
+                if top is not None:
+                    values = []
+                    async for value in self.iter_field_values(field, page_size=min(top, 1000)):
+                        values.append(value)
+                        if len(values) >= top:
+                            break
+                else:
+                    q = self._field_values_query(field, max)
+                    values = self._sorted_values(await self._fetch(q), q)
+                self.registry.set(key, values)
+            self._field_cache[cache_key] = values
+        return self._field_cache[cache_key]
+
+    async def iter_field_values(self, field, page_size=1000):
+        '''
+        Yield the values for a field a page at a time. See
+        BWQuery.iter_field_values.
+        '''
+        start = 0
+        while True:
+            q = self._field_values_query(field, max=start + page_size - 1, start=start)
+            values = self._sorted_values(await self._fetch(q), q)
+            if len(values) == 0:
+                return
+            for value in values:
+                yield value
+            start += page_size
+
+    async def limited_field_values(self, field):
+        q = self._limited_field_values_query(field)
+        json_response = await self._fetch(q)
+        self._field_cache[field] = self._sorted_values(json_response, q)
+
+    async def _fetch(self, query):
+        timer = Timer()
+        key, response = self._from_cache(query)
+        if response is not None:
+            logging.debug("Cache hit")
+            timer.lap('cache')
+            self._emit_fetch(query, timer, cache='hit')
+            return response
+
+        response = self._rollup_from_cache(query)
+        if response is not None:
+            logging.debug("Rolled up from a cached result")
+            timer.lap('rollup')
+            self._to_cache(key, response, query)
+            self._emit_fetch(query, timer, cache='rollup')
+            return response
+
+        # Share the download with an identical query in flight on this loop
+        flight = (asyncio.get_running_loop(), self._flight_key(query))
+        task = _in_flight.get(flight)
+        owner = task is None
+        if owner:
+            task = _in_flight[flight] = asyncio.ensure_future(self._download(query, timer))
+            task.add_done_callback(lambda t: _in_flight.pop(flight, None))
+        response, size = await asyncio.shield(task)
+        if not owner:
+            logging.debug("Shared the response to an identical query in flight")
+            timer.lap('coalesced')
+            self._emit_fetch(query, timer, cache='coalesced')
+            return response
+        logging.debug("Query time: %.3fs" % timer.total())
+        self._to_cache(key, response, query)
+        self._emit_fetch(query, timer, cache='miss' if key else None, bytes=size)
+        return response
+
+    async def _download(self, query, timer):
+        terms = jsonlib.dumps(query)
+        timer.lap('encode')
+        async with self._semaphore:
+            timer.lap('queue')
+            body = await self._send(terms, timer)
+        response = jsonlib.loads(body)
+        timer.lap('decode')
+        return response, len(body)
+
+    async def _send(self, terms, timer, stream=False):
+        '''
+        Send encoded query terms and return the response body, failing over
+        between endpoints if the endpoint is an EndpointPool. With stream,
+        return the open response instead, for the caller to read and release.
+        '''
+        if not isinstance(self.endpoint, EndpointPool):
+            return await self._query(self.endpoint, terms, timer, stream)
+
+        pool = self.endpoint
+        error = None
+        for url in pool.candidates():
+            pool.start(url)
+            start = time.time()
+            seconds, failed = None, None
+            try:
+                body = await self._query(url, terms, timer, stream)
+                seconds, failed = time.time() - start, False
+                return body
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Timeouts and connection errors have no status
+                failed = getattr(e, 'status', 500) >= 500
+                if not failed:
+                    raise
+                logging.warning("Query to %s failed, trying another endpoint: %r" % (url, e))
+                error = e
+            finally:
+                # Always runs, even if cancelled, so outstanding counts stay right
+                pool.finish(url, seconds, failed)
+        raise error
+
+    async def _query(self, endpoint, terms, timer, stream=False):
+        ''' Send query terms to one endpoint, with POST if they are long. '''
+        url, body, headers = encode_query(endpoint, terms, _globals.get('post_threshold'),
+                                          _globals.get('compress_posts') or ())
+        return await self._read(url, body, headers, timer, stream)
+
+    async def _read(self, url, body, headers, timer, stream=False):
+        kwargs = {} if self._verify_cert else {'ssl': False}
+        session = self._get_session()
+        if body is None:
+            request = session.get(url, **kwargs)
+        else:
+            request = session.post(url, data=body, headers=headers, **kwargs)
+        if stream:
+            r = await request
+            try:
+                r.raise_for_status()
+            except aiohttp.ClientResponseError:
+                r.release()
+                raise
+            timer.lap('first_byte')
+            return r
+        async with request as r:
+            r.raise_for_status()
+            timer.lap('first_byte')
+            body = await r.read()
+            timer.lap('body')
+        return body
+
+    def _get_session(self):
+        if self._session is None and self._parent is not None:
+            self._session = self._parent._get_session()
+        elif self._session is None:
+            connector = aiohttp.TCPConnector(limit=self._max_concurrency)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
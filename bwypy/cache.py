@@ -0,0 +1,213 @@
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def _as_list(value):
+    return value if type(value) is list else [value]
+
+
+def canonical_query(query):
+    '''
+    Return a stable string form of a query dict, so that equivalent queries
+    map to the same cache entry. Keys are sorted and `groups`/`counttype`
+    are always lists.
+    '''
+    q = dict(query)
+    for prop in ['groups', 'counttype']:
+        if prop in q and type(q[prop]) is not list:
+            q[prop] = [q[prop]]
+    # The stdlib encoder is used regardless of ujson, so that on-disk keys
+    # are identical between environments.
+    return json.dumps(q, sort_keys=True, separators=(',', ':'))
+
+
+class QueryCache:
+    '''
+    A cache for raw Bookworm responses, with an in-memory LRU tier and an
+    optional SQLite tier for persisting results between processes.
+
+    Enable it for all queries with `set_options(cache=QueryCache(...))`.
+
+    maxsize: Number of responses to hold in memory.
+    path: Path to a SQLite file. If None, only the memory tier is used.
+    ttl: Seconds that a response stays valid. None means no expiry.
+
+    Responses are kept encoded, so every hit returns a fresh copy that the
+    caller can change without changing the cache.
+    '''
+
+    def __init__(self, maxsize=256, path=None, ttl=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        # Groups and counttypes of cached responses, by the rest of the query
+        self._supersets = {}
+        self._lock = threading.RLock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses "
+                             "(key TEXT PRIMARY KEY, expires REAL, body TEXT)")
+            self._db.commit()
+
+    def key(self, endpoint, query):
+        ''' Cache key for a query sent to a given endpoint. '''
+        raw = "%s|%s|%s" % (endpoint, query.get('database'),
+                            canonical_query(query))
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        ''' Return the cached response for key, or None. '''
+        now = time.time()
+        with self._lock:
+            if key in self._memory:
+                expires, body = self._memory[key]
+                if expires is None or expires > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(body)
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT expires, body FROM responses "
+                                       "WHERE key=?", (key,)).fetchone()
+                if row is not None:
+                    expires, body = row
+                    if expires is None or expires > now:
+                        self._remember(key, expires, body)
+                        self.hits += 1
+                        return json.loads(body)
+                    self._db.execute("DELETE FROM responses WHERE key=?", (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key, response):
+        ''' Store a response in every tier. '''
+        expires = None if self.ttl is None else time.time() + self.ttl
+        body = json.dumps(response)
+        with self._lock:
+            self._remember(key, expires, body)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                                 (key, expires, body))
+                self._db.commit()
+
+    def index(self, endpoint, query, key):
+        '''
+        Note the groups and counttypes of a cached response, so that
+        `find_superset` can find it. Only the memory of this process is
+        indexed.
+        '''
+        entry = (_as_list(query.get('groups', [])),
+                 _as_list(query.get('counttype', [])), key)
+        with self._lock:
+            entries = self._supersets.setdefault(self._base_key(endpoint, query), [])
+            if entry not in entries:
+                entries.append(entry)
+
+    def find_superset(self, endpoint, query):
+        '''
+        Find a cached response to the same query, but with at least the
+        requested groups and counttypes. Returns `(groups, counttypes,
+        response)` for the one with the fewest groups, or None.
+        '''
+        groups = set(_as_list(query.get('groups', [])))
+        counttypes = set(_as_list(query.get('counttype', [])))
+        with self._lock:
+            entries = self._supersets.get(self._base_key(endpoint, query), [])
+            for entry in sorted(entries, key=lambda e: len(e[0])):
+                cached_groups, cached_counttypes, key = entry
+                if not (groups <= set(cached_groups) and
+                        counttypes <= set(cached_counttypes)):
+                    continue
+                response = self.get(key)
+                if response is None:
+                    entries.remove(entry)
+                    continue
+                return cached_groups, cached_counttypes, response
+        return None
+
+    def _base_key(self, endpoint, query):
+        q = dict(query)
+        q.pop('groups', None)
+        q.pop('counttype', None)
+        return "%s|%s" % (endpoint, canonical_query(q))
+
+    def _remember(self, key, expires, body):
+        self._memory[key] = (expires, body)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        ''' Empty all tiers and reset the counters. '''
+        with self._lock:
+            self._memory.clear()
+            self._supersets.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        ''' Return hit/miss counts and the current size of the memory tier. '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._memory)}
+
+    def __len__(self):
+        return len(self._memory)
+
+
+class SingleFlight:
+    '''
+    Coalesces concurrent calls for the same key: while one call is running,
+    others with its key wait for it and share its result.
+    '''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        '''
+        Call func(), or wait for the running call with the same key. Returns
+        the result and whether this call ran func.
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            owner = call is None
+            if owner:
+                call = self._calls[key] = _Call()
+        if not owner:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, False
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, True
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
@@ -2,16 +2,47 @@ try:
     import ujson as jsonlib
 except:
     import json as jsonlib
-import pandas as pd
 import logging
 import time
-import urllib
-import numpy as np
 import copy
+import csv
+import importlib
+import itertools
+
+from collections import defaultdict, namedtuple
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from bwypy.cache import QueryCache, SingleFlight, canonical_query
+from bwypy.registry import FieldRegistry, default_registry
+from bwypy.transport import HTTPTransport, EndpointPool, default_transport, endpoint_pool
+from bwypy.instrument import Timer, TimingAggregator
+
+
+class _LazyModule:
+    '''
+    Stands in for a module, importing it on first use. pandas and numpy are
+    only needed once results are turned into tables, so building and
+    running queries doesn't pay for importing them.
+    '''
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+pd = _LazyModule('pandas')
+np = _LazyModule('numpy')
 
-from collections import defaultdict
 _globals = defaultdict(lambda: None)
 
+# Downloads in progress, so that identical concurrent queries share one
+_in_flight = SingleFlight()
+
 class set_options(object):
 
     def __init__(self, **kwargs):
@@ -25,6 +56,46 @@ class set_options(object):
         _globals.clear()
         _globals.update(self.old)
 
+def _emit(event):
+    '''
+    Send an instrumentation event to the hooks set with
+    `set_options(instrument=...)`, which may be a callable or a list of them.
+    '''
+    hooks = _globals.get('instrument')
+    if hooks is None:
+        return
+    if callable(hooks):
+        hooks = [hooks]
+    for hook in hooks:
+        hook(event)
+
+
+class _FieldIndex(namedtuple('_FieldIndex', ['groups', 'limits'])):
+    '''
+    Immutable lookups for validating against the fields in a Bookworm.
+
+    groups: Accepted group names, including the '__id' and '*' variants.
+    limits: Accepted search_limits keys.
+    '''
+
+    @classmethod
+    def build(cls, names):
+        names = list(names)
+        ids = [name + '__id' for name in names]
+        groups = frozenset(names + ids + ['*' + name for name in names + ids])
+        limits = frozenset(names + ids + ['word'])
+        return cls(groups, limits)
+
+
+def _snapshot(query):
+    '''
+    Copy a query deeply enough to undo changes made through the property
+    getters, e.g. `bw.search_limits['field'] = value`, without a deepcopy.
+    '''
+    return {k: (copy.copy(v) if type(v) in (dict, list) else v)
+            for k, v in query.items()}
+
+
 class BWQuery:
     default = {"search_limits": {},
                "words_collation": "Case_Sensitive",
@@ -32,22 +103,34 @@ class BWQuery:
                "format":"json",
                "counttype": ["TextCount", "WordCount"], "groups": []}
 
-    def __init__(self, json=None, endpoint=None, database=None, verify_fields=True, verify_cert=True):
+    def __init__(self, json=None, endpoint=None, database=None, verify_fields=True, verify_cert=True,
+                 transport=None):
         '''
+        endpoint: The URL of the Bookworm API, or a list of equivalent URLs
+            or an EndpointPool to spread queries over.
+
         verify_fields: Whether to ask the server for the allowable fields and
             verify later calls accordingly. Turn this offer for a performance
             improvement, because it saves a call to the server.
             
             Validation checks are always done if fields are available. If you turn
             off verify_fields but later run `fields()`, checks will resume.
+
+        transport: An HTTPTransport to send queries through. By default, the
+            transport set with `set_options(transport=...)` is used, or else
+            one pooled transport shared by all queries.
         '''
+        # Field records from the server, and a DataFrame of them once asked for
         self._fields = None
+        self._fields_frame = None
+        self._field_index = None
         self._last_good = None
         # Explicit data type definition
         self._dtypes = {}
         self._field_cache = {}
         # Allow turning off SSL verification if there are cert issues
         self._verify_cert = verify_cert
+        self._transport = transport
         
         if json:
             if type(json) == dict:
@@ -55,7 +138,7 @@ class BWQuery:
             else:
                 self.json = jsonlib.decode(json)
         else:
-            self.json = copy.deepcopy(self.default)
+            self.json = _snapshot(self.default)
             
         if endpoint:
             self.endpoint = endpoint            
@@ -64,6 +147,8 @@ class BWQuery:
         else:
             raise NameError("No endpoint. Provide to BWQuery on initialization "
                             "or set globally.")
+        if type(self.endpoint) in (list, tuple):
+            self.endpoint = endpoint_pool(self.endpoint)
         
         if database:
             self.json['database'] = database
@@ -76,7 +161,7 @@ class BWQuery:
         
         # Run check for all available fields
         if verify_fields:
-            self.fields()
+            self._load_fields()
         
         self._validate()
 
@@ -93,10 +178,10 @@ class BWQuery:
                 validate_func = getattr(self, '_validate_' + prop)(getattr(self, prop))
 
             # Because of the way some setters work, it's worthwhile keeping the last known 'good' copy
-            self._last_good = copy.deepcopy(self.json)
+            self._last_good = _snapshot(self.json)
         except:
             if self._last_good is not None:
-                self.json = copy.deepcopy(self._last_good)
+                self.json = _snapshot(self._last_good)
             raise
             
     
@@ -118,13 +203,10 @@ class BWQuery:
         self.json['groups'] = value
             
     def _validate_groups(self, value):
-        if self._fields is not None:
-            accepted = (self._fields['name'].tolist() +
-                    (self._fields['name'] + '__id').tolist() +
-                    ('*' + self._fields['name']).tolist() +
-                    ('*' + self._fields['name'] + '__id').tolist()
-                    )
-            badgroups = np.setdiff1d(value, accepted)
+        if self._field_index is not None:
+            if type(value) is not list:
+                value = [value]
+            badgroups = sorted(set(value) - self._field_index.groups)
             if len(badgroups) > 0:
                 raise KeyError("The following groups are not supported in this BW: %s" % ", ".join(badgroups))
         
@@ -149,12 +231,8 @@ class BWQuery:
         self.json['search_limits'] = value
         
     def _validate_search_limits(self, value):
-        if self._fields is not None:
-            accepted = (self._fields['name'].tolist() +
-                    (self._fields['name'] + '__id').tolist() +
-                    ['word']
-                    )
-            badgroups = np.setdiff1d(list(value.keys()), accepted)
+        if self._field_index is not None:
+            badgroups = sorted(set(value) - self._field_index.limits)
             if len(badgroups) > 0:
                 raise KeyError("The following search_limit fields are not supported in this BW: %s" % ", ".join(badgroups))
                 
@@ -162,6 +240,19 @@ class BWQuery:
             raise TypeError("word value needs to be a list, even if there is only one word.")
             
         
+    @property
+    def transport(self):
+        if self._transport is not None:
+            return self._transport
+        elif _globals.get('transport') is not None:
+            return _globals['transport']
+        else:
+            return default_transport()
+
+    @transport.setter
+    def transport(self, value):
+        self._transport = value
+
     @property
     def counttype(self):
         return self.json['counttype']
@@ -174,44 +265,501 @@ class BWQuery:
         '''
         Return Pandas object with all the fields in a Bookworm
         '''
+        self._load_fields()
+        return self._field_frame()
+
+    def _load_fields(self):
         if self._fields is None:
-            q = {'database': self.json['database'],
-                 'method': 'returnPossibleFields'}
-            obj = self._fetch(q)
-            df = pd.DataFrame(obj)
-            self._fields = df
-            self._dtypes = df[['name', 'type']].set_index('name').to_dict()['type']
-        return self._fields
+            obj = self.registry.get(self._registry_key('fields'),
+                                    lambda: self._fetch(self._fields_query()))
+            self._set_fields(obj)
+
+    def _field_frame(self):
+        if self._fields_frame is None:
+            self._fields_frame = pd.DataFrame(self._fields)
+        return self._fields_frame
+
+    @property
+    def registry(self):
+        ''' The FieldRegistry that field metadata is shared through. '''
+        if _globals.get('field_registry') is not None:
+            return _globals['field_registry']
+        return default_registry()
+
+    def _registry_key(self, *parts):
+        return FieldRegistry.key(self.endpoint, self.database, *parts)
+
+    def _fields_query(self):
+        return {'database': self.json['database'],
+                'method': 'returnPossibleFields'}
+
+    def _set_fields(self, obj):
+        self._fields = obj
+        self._fields_frame = None
+        self._dtypes = {field['name']: field['type'] for field in obj}
+        self._field_index = _FieldIndex.build(self._dtypes.keys())
                      
-    def run(self):
+    def run(self, stream=False, local_ratios=None):
+        '''
+        stream: Parse the response incrementally as it downloads, filling the
+            results table directly instead of decoding the whole body into a
+            nested dict first. Requires ijson. Streamed responses are not
+            stored in the cache.
+        local_ratios: Compute WordsPerMillion and TextPercent here, from the
+            WordCount and TextCount of this query and of the same query
+            without the word limit. The latter, the denominators, are
+            fetched once and kept in the field registry, so sweeps over many
+            words don't have the server total the corpus every time. By
+            default, follows `set_options(local_ratios=...)`. Can't be
+            combined with stream.
+        '''
+        if local_ratios is None:
+            local_ratios = _globals.get('local_ratios')
+        local_ratios = local_ratios and len(self._ratio_counttypes()) > 0
+        if stream:
+            if local_ratios:
+                raise ValueError("local_ratios can't be computed for streamed results")
+            return BWResults.from_rows(self.iter_rows(), self.json, self._dtypes)
+
         self._validate()
         self._runtime_validate()
-            
+
+        if local_ratios:
+            base = self._base_counts_query()
+            denominator = self._denominator_query()
+            denominators = self.registry.get(
+                self._registry_key('denominators', canonical_query(denominator)),
+                lambda: self._fetch(denominator)['data'])
+            logging.debug("Running " + jsonlib.dumps(base))
+            json_response = self._fetch(base)
+            return _with_ratios(json_response['data'], base, denominators,
+                                self.json, self._dtypes)
+
         logging.debug("Running " + jsonlib.dumps(self.json))
         json_response = self._fetch(self.json)
         
         return BWResults(json_response['data'], self.json, self._dtypes)
 
-    def field_values(self, field, max=None):
-        ''' Return all possible values for a field. '''
-        if field not in self._field_cache:
-            q = copy.deepcopy(self.default)
-            q['database'] = self.database
-            if max is not None:
-                q['search_limits'] = { field+'__id': { '$lt' : max+1} }
-                q['groups'] = '*'+field
+    def _ratio_counttypes(self):
+        '''
+        Return the ratio counttypes in this query, if they can be computed
+        locally, else an empty list.
+        '''
+        counttypes = self.counttype if type(self.counttype) is list else [self.counttype]
+        ratios = [c for c in counttypes if c in _ratio_counttypes]
+        others = set(counttypes) - set(ratios) - set(_additive_counttypes)
+        # Lists of search limits are combined on the server, and so are the
+        # denominators for starred groups, which drop that group's limit
+        groups = self.groups if type(self.groups) is list else [self.groups]
+        if others or type(self.json.get('search_limits', {})) is not dict \
+                or any(g.startswith('*') for g in groups):
+            return []
+        return ratios
+
+    def _base_counts_query(self):
+        ''' This query, with the counts needed for its ratios in their place. '''
+        counttypes = self.counttype if type(self.counttype) is list else [self.counttype]
+        base = []
+        for c in counttypes:
+            c = _ratio_counttypes[c][0] if c in _ratio_counttypes else c
+            if c not in base:
+                base.append(c)
+        query = dict(self.json)
+        query['counttype'] = base
+        return query
+
+    def _denominator_query(self):
+        '''
+        The query for the corpus totals that ratios are relative to: the
+        compare_limits if there are any, or else the search_limits without
+        the word.
+        '''
+        query = dict(self.json)
+        compare = query.pop('compare_limits', None)
+        if compare:
+            limits = compare
+        else:
+            limits = {k: v for k, v in query['search_limits'].items() if k != 'word'}
+        query['search_limits'] = limits
+        query['counttype'] = ['TextCount', 'WordCount']
+        return query
+
+    def iter_rows(self):
+        '''
+        Run the query, yielding a `(group values, counts)` pair for each row
+        as the response is parsed. Useful for writing very large results
+        somewhere without holding them in memory. Requires ijson.
+        '''
+        self._validate()
+        self._runtime_validate()
+
+        timer = Timer()
+        key, response = self._from_cache(self.json)
+        if response is not None:
+            timer.lap('cache')
+            self._emit_fetch(self.json, timer, cache='hit')
+            for row in BWResults(response['data'], self.json)._iter_leaves():
+                yield row
+            return
+
+        ijson = _import_ijson()
+        logging.debug("Streaming " + jsonlib.dumps(self.json))
+        groups = self.json['groups']
+        ngroups = len(groups) if type(groups) is list else 1
+        terms = jsonlib.dumps(self.json)
+        timer.lap('encode')
+        r = self._send(terms, stream=True)
+        timer.lap('first_byte')
+        rows = 0
+        with closing(r):
+            r.raw.decode_content = True
+            events = ijson.basic_parse(r.raw, use_float=True)
+            for row in _parse_rows(events, ngroups):
+                rows += 1
+                yield row
+        # Includes the time spent by the consumer of the rows
+        timer.lap('stream')
+        logging.debug("Query time: %.3fs" % timer.total())
+        self._emit_fetch(self.json, timer, rows=rows)
+
+    def run_many(self, queries, max_workers=8):
+        '''
+        Run several queries concurrently, returning their BWResults in the
+        same order as `queries`.
+
+        queries: A list of BWQuery objects or query dicts. Dicts only need
+            the properties that differ from this query, e.g.
+            `{'search_limits': {'word': ['whale']}}`. Everything else,
+            including the endpoint and transport, is taken from this query.
+        max_workers: The number of queries in flight at once.
+
+        A query that fails returns its exception in place of a BWResults, so
+        one failure doesn't cancel the rest.
+        '''
+        results = [None] * len(queries)
+        for i, result in self.iter_many(queries, max_workers=max_workers):
+            results[i] = result
+        return results
+
+    def iter_many(self, queries, max_workers=8):
+        '''
+        Like `run_many`, but yield `(index, result)` pairs as each query
+        completes.
+        '''
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(self._run_derived, q): i
+                       for i, q in enumerate(queries)}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = e
+                yield futures[future], result
+
+    def run_sharded(self, field, step=None, values=None, target_rows=None,
+                    target_seconds=None, max_workers=8):
+        '''
+        Run the query as several smaller queries, split along the search
+        limits for one field, and merge them into a single BWResults. Useful
+        for grouped queries that time out or are too big for the server.
+
+        field: The field to split along. Integer fields, like date_year, are
+            split into `$gte`/`$lt` ranges within the current limits on that
+            field (or its full range of values). Other fields are split into
+            lists of values.
+        step: The size of each shard, as a span of numbers or a number of
+            values. By default, the work is split evenly over max_workers.
+        values: For non-integer fields, the values to split. Defaults to the
+            values in the current search limits, or else `field_values()`.
+        target_rows, target_seconds: Rather than a step, size shards so that
+            they return about this many rows, or take about this long. A
+            first shard is run on its own to measure this.
+        max_workers: The number of shards in flight at once.
+
+        If `field` isn't one of the groups, shard counts are summed, which
+        only makes sense for TextCount and WordCount.
+        '''
+        groups, counttypes = self._sharding(field)
+        lo = None
+        if values is None and self._is_range_field(field):
+            lo, hi = self._field_range(field)
+            size = hi - lo
+        else:
+            if values is None:
+                values = self._limit_values(field)
+            if values is None:
+                values = self.field_values(field)
+            size = len(values)
+        shard = lambda start, stop: self._shard(field, start, stop, lo, size, values)
+
+        merged = None
+        done = 0
+        if step is None and (target_rows or target_seconds):
+            # Measure a small first shard to size the rest
+            done = max(1, size // (max_workers * 4))
+            start = time.time()
+            merged = self._derive(shard(0, done)).run().json()
+            step = _shard_step(done, merged, time.time() - start, len(groups),
+                               target_rows, target_seconds)
+        elif step is None:
+            step = max(1, -(-size // max_workers))
+
+        shards = [shard(i, i + step) for i in range(done, size, step)]
+        logging.debug("Running %d shards of %s" % (len(shards), field))
+        results = self.run_many(shards, max_workers=max_workers)
+        return self._merge_shards(merged, results, groups, counttypes)
+
+    def _sharding(self, field):
+        ''' Check that the query can be sharded, returning its groups and counttypes. '''
+        self._validate()
+        groups = self._stripped_groups()
+        counttypes = self.counttype if type(self.counttype) is list else [self.counttype]
+        if field not in groups and not set(counttypes) <= set(_additive_counttypes):
+            raise ValueError("Can only shard on a field outside of groups when "
+                             "counttypes are all in %s" % ", ".join(_additive_counttypes))
+        return groups, counttypes
+
+    def _shard(self, field, start, stop, lo, size, values):
+        '''
+        The query for shard [start, stop): a span of numbers from lo, or a
+        slice of values if lo is None.
+        '''
+        limits = dict(self.search_limits)
+        if lo is not None:
+            limits[field] = {'$gte': lo + start, '$lt': lo + min(stop, size)}
+        else:
+            limits[field] = list(values[start:stop])
+        return {'search_limits': limits}
+
+    def _merge_shards(self, merged, results, groups, counttypes):
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+            if merged is None:
+                merged = result.json()
+            else:
+                merged = _merge_nested(merged, result.json())
+
+        if merged is None:
+            merged = {} if len(groups) > 0 else [0] * len(counttypes)
+        return BWResults(merged, self.json, self._dtypes)
+
+    def refresh(self, start, stop=None, field='date_year', previous=None):
+        '''
+        Update earlier results of this query by running it again only for
+        values of an integer field in [start, stop), and splicing the new
+        cells into a copy of the earlier results. Useful when only recent
+        years have changed.
+
+        start, stop: The range of values to re-run. stop defaults to the end
+            of the query's range for the field.
+        field: The field to re-run by. It must be one of the groups.
+        previous: The BWResults to update. By default, the cached result of
+            this query is used, if there is one; otherwise the whole query is
+            run.
+
+        The updated results replace the cached ones, if a cache is set.
+        '''
+        key, previous = self._refresh_previous(field, previous)
+        if previous is None:
+            return self.run()
+        values = self._limit_values(field)
+        if values is None:
+            lo, hi = self._field_range(field)
+            start = max(start, lo)
+            stop = hi if stop is None else min(stop, hi)
+        if _empty_refresh(start, stop, values):
+            return previous
+        delta = self._refresh_query(field, start, stop, values).run().json()
+        return self._refresh_splice(key, previous, delta, field, start, stop)
+
+    def _refresh_previous(self, field, previous):
+        '''
+        Check that this query can be refreshed by field, returning its cache
+        key and the results to update: previous, or else the cached results,
+        or None if there are none.
+        '''
+        self._validate()
+        if field not in self._stripped_groups():
+            raise ValueError("Can only refresh by one of the groups, not %s" % field)
+        key, response = self._from_cache(self.json)
+        if previous is None:
+            if response is None:
+                return key, None
+            previous = BWResults(response['data'], self.json, self._dtypes)
+        counttypes = self.counttype if type(self.counttype) is list else [self.counttype]
+        if previous.groups != self._stripped_groups() or previous.counttype != counttypes:
+            raise ValueError("The previous results are for different groups or counttypes")
+        return key, previous
+
+    def _stripped_groups(self):
+        return [g.lstrip('*') for g in (self.groups if type(self.groups) is list
+                                        else [self.groups])]
+
+    def _refresh_query(self, field, start, stop, values=None):
+        '''
+        A variant of this query for values of field in [start, stop). If the
+        query limits field to a list of values, only the listed values in
+        that span are queried, still as a list; stop may then be None.
+        '''
+        limits = dict(self.search_limits)
+        if values is None:
+            limits[field] = {'$gte': start, '$lt': stop}
+        else:
+            limits[field] = [v for v in values if _in_span(v, start, stop)]
+        logging.debug("Refreshing %s from %s to %s" % (field, start, stop))
+        return self._derive({'search_limits': limits})
+
+    def _refresh_splice(self, key, previous, delta, field, start, stop):
+        ''' Splice refreshed results into previous ones, and cache them. '''
+        replaced = lambda value: _in_span(value, start, stop)
+        depth = self._stripped_groups().index(field)
+        merged = _splice(previous.json(), delta, depth, replaced)
+        self._to_cache(key, {'status': 'success', 'data': merged}, self.json)
+        return BWResults(merged, self.json, self._dtypes)
+
+    def _is_range_field(self, field):
+        '''
+        Whether field is limited to a range of numbers, or is an integer
+        field with no limits. Limits to a list of values are kept as values.
+        '''
+        limit = self.search_limits.get(field)
+        if type(limit) is dict:
+            return len(set(limit) & set(['$gt', '$gte', '$lt', '$lte'])) > 0
+        return limit is None and self._dtypes.get(field) == 'integer'
+
+    def _limit_values(self, field):
+        ''' The values that search_limits allow for field, or None for any. '''
+        limit = self.search_limits.get(field)
+        if limit is None or type(limit) is dict:
+            return None
+        return limit if type(limit) is list else [limit]
+
+    def _field_range(self, field):
+        ''' Return [low, high) bounds for an integer field. '''
+        lo, hi = self._limit_range(field)
+        if lo is None or hi is None:
+            return _fill_range(lo, hi, self.field_values(field))
+        return int(lo), int(hi)
+
+    def _limit_range(self, field):
+        ''' [low, high) bounds from the search limits, with None if open. '''
+        limit = self.search_limits.get(field)
+        if type(limit) is not dict:
+            limit = {}
+        lo, hi = limit.get('$gte'), limit.get('$lt')
+        if lo is None and '$gt' in limit:
+            lo = limit['$gt'] + 1
+        if hi is None and '$lte' in limit:
+            hi = limit['$lte'] + 1
+        return lo, hi
+
+    def _run_derived(self, query):
+        if isinstance(query, BWQuery):
+            return query.run()
+        return self._derive(query).run()
+
+    def _derive(self, query):
+        '''
+        Return a copy of this BWQuery with the properties in `query`
+        replacing its own. Field metadata and the transport are shared.
+        '''
+        return self._variant(copy.deepcopy(query))
+
+    def with_limits(self, limits=None, **kwargs):
+        '''
+        Return a variant of this query with some search_limits changed, e.g.
+        `bw.with_limits(word=['whale'])` or
+        `bw.with_limits({'date_year': {'$gte': 1900}})`. Limits given as None
+        are removed.
+
+        Variants are cheap to make: they share field metadata, the transport,
+        and the parts of the query that don't change with this query, and
+        only the changed limits are validated. Since parts are shared, give
+        a variant new values rather than modifying its limits in place.
+        '''
+        changes = dict(limits or {}, **kwargs)
+        self._validate_search_limits({k: v for k, v in changes.items() if v is not None})
+        search_limits = dict(self.search_limits)
+        for k, v in changes.items():
+            if v is None:
+                search_limits.pop(k, None)
+            else:
+                search_limits[k] = v
+        return self._variant({'search_limits': search_limits})
+
+    def with_groups(self, groups):
+        ''' Return a variant of this query with other groups. See `with_limits`. '''
+        self._validate_groups(groups)
+        return self._variant({'groups': groups})
+
+    def _variant(self, changes):
+        # A shallow copy, with a new top level for the query and its own
+        # field values cache, since limited_field_values replaces its entries
+        bw = copy.copy(self)
+        bw.json = dict(self.json)
+        bw.json.update(changes)
+        bw._field_cache = dict(self._field_cache)
+        bw._last_good = None
+        return bw
+
+    def field_values(self, field, max=None, top=None):
+        '''
+        Return all possible values for a field.
+
+        max: Only return values with an __id up to max.
+        top: Only return the `top` most common values, fetched a page at a
+            time with `iter_field_values`. Use this for fields with many
+            values, like author or publisher.
+        '''
+        key = field if max is None and top is None else (field, max, top)
+        if key not in self._field_cache:
+            if top is not None:
+                pages = self.iter_field_values(field, page_size=min(top, 1000))
+                fetch = lambda: list(itertools.islice(pages, top))
             else:
-                q['groups'] = field
-            json_response = self._fetch(q)
-            values = (BWResults(json_response, q).dataframe()
-                            .sort_values('TextCount', ascending=False)
-                            .index
-                            .tolist())
-            self._field_cache[field] = values
-        return self._field_cache[field]
+                q = self._field_values_query(field, max)
+                fetch = lambda: self._sorted_values(self._fetch(q), q)
+            self._field_cache[key] = self.registry.get(
+                self._registry_key('values', field, max, top), fetch)
+        return self._field_cache[key]
+
+    def iter_field_values(self, field, page_size=1000):
+        '''
+        Yield the values for a field, from most to least common, fetching
+        them from the server a page at a time. Pages are windows of the
+        field's __id, which Bookworm assigns in order of frequency, so pages
+        are only fetched as they are consumed.
+        '''
+        start = 0
+        while True:
+            q = self._field_values_query(field, max=start + page_size - 1, start=start)
+            values = self._sorted_values(self._fetch(q), q)
+            if len(values) == 0:
+                return
+            for value in values:
+                yield value
+            start += page_size
     
     def limited_field_values(self, field):
-        q = copy.deepcopy(self.json)
+        q = self._limited_field_values_query(field)
+        json_response = self._fetch(q)
+        self._field_cache[field] = self._sorted_values(json_response, q)
+
+    def _field_values_query(self, field, max=None, start=None):
+        q = _snapshot(self.default)
+        q['database'] = self.database
+        if max is not None:
+            q['search_limits'] = { field+'__id': { '$lt' : max+1} }
+            if start is not None:
+                q['search_limits'][field+'__id']['$gte'] = start
+            q['groups'] = '*'+field
+        else:
+            q['groups'] = field
+        return q
+
+    def _limited_field_values_query(self, field):
+        q = _snapshot(self.json)
         try:
             del q['search_limits']['word']
         except:
@@ -220,14 +768,17 @@ class BWQuery:
             q['groups'].append(field)
         else:
             q['groups'] = [q['groups'], field]
-            
-        json_response = self._fetch(q)
-        values = (BWResults(json_response, q).dataframe()
-                  .sort_values('TextCount', ascending=False)
-                  .index
-                  .tolist())
-        self._field_cache[field] = values
-        
+        return q
+
+    def _sorted_values(self, json_response, q):
+        ''' Values of a grouped query, from most to least common. '''
+        results = BWResults(json_response['data'], q)
+        df = results.dataframe()
+        # Frames are already sorted by the first counttype
+        if results.counttype[0] != 'TextCount':
+            df = df.sort_values('TextCount', ascending=False)
+        return df.index.tolist()
+
     def stats(self):
         q = self.default.copy()
         # Let's hope nobody creates a bookworm on the history of the universe:
@@ -240,24 +791,150 @@ class BWQuery:
             Bookworm's built-in DataFrame return method, as JSON is a more
             transparent and safer format for data interchange.
         '''
-        start = time.time()
-        qurl = "%s?queryTerms=%s" % (self.endpoint, jsonlib.dumps(query))
-        try:
-            f = urllib.urlopen(qurl)
-            response = jsonlob.loads(f.read())
-        except:
-            # Python 3, being lazy here
-            import requests
-            r = requests.get(qurl, verify=self._verify_cert)
-            response = r.json()
-        logging.debug("Query time: %ds" % (time.time()-start))
+        timer = Timer()
+        key, response = self._from_cache(query)
+        if response is not None:
+            logging.debug("Cache hit")
+            timer.lap('cache')
+            self._emit_fetch(query, timer, cache='hit')
+            return response
+
+        response = self._rollup_from_cache(query)
+        if response is not None:
+            logging.debug("Rolled up from a cached result")
+            timer.lap('rollup')
+            self._to_cache(key, response, query)
+            self._emit_fetch(query, timer, cache='rollup')
+            return response
+
+        (response, size), owner = _in_flight.do(
+            self._flight_key(query), lambda: self._download(query, timer))
+        if not owner:
+            logging.debug("Shared the response to an identical query in flight")
+            timer.lap('coalesced')
+            self._emit_fetch(query, timer, cache='coalesced')
+            return response
+        logging.debug("Query time: %.3fs" % timer.total())
+        self._to_cache(key, response, query)
+        self._emit_fetch(query, timer, cache='miss' if key else None, bytes=size)
+        return response
+
+    def _download(self, query, timer):
+        ''' Send a query to the server, returning the response and its size. '''
+        terms = jsonlib.dumps(query)
+        timer.lap('encode')
+        # Streamed, so that waiting for the server and downloading the body
+        # can be timed separately
+        r = self._send(terms, stream=True)
+        timer.lap('first_byte')
+        content = r.content
+        timer.lap('body')
+        response = jsonlib.loads(content)
+        timer.lap('decode')
+        return response, len(content)
+
+    def _flight_key(self, query):
+        return "%s|%s" % (self.endpoint, canonical_query(query))
+
+    def _rollup_from_cache(self, query):
+        '''
+        With `set_options(rollup=True)`, answer a query from a cached result
+        with the same search_limits and more groups, by summing over the
+        groups that aren't wanted. Only TextCount and WordCount are summed;
+        other counttypes go to the server.
+
+        A book with several values of a dropped field is counted once for
+        each, so only turn this on where that doesn't matter.
+        '''
+        cache = _globals.get('cache')
+        if cache is None or not _globals.get('rollup') or query.get('method') != 'data':
+            return None
+        groups = query['groups'] if type(query['groups']) is list else [query['groups']]
+        counttypes = query['counttype'] if type(query['counttype']) is list else [query['counttype']]
+        if not set(counttypes) <= set(_additive_counttypes):
+            return None
+        found = cache.find_superset(self.endpoint, query)
+        if found is None:
+            return None
+        from_groups, from_counttypes, cached = found
+        response = dict(cached)
+        response['data'] = _rollup(cached['data'], from_groups, from_counttypes,
+                                   groups, counttypes)
         return response
+
+    def _emit_fetch(self, query, timer, **details):
+        event = {'event': 'fetch', 'endpoint': self.endpoint,
+                 'database': query.get('database'), 'method': query.get('method'),
+                 'query': query, 'phases': timer.phases}
+        event.update(details)
+        _emit(event)
+
+    def _send(self, terms, stream=False):
+        '''
+        Send encoded query terms to the endpoint. If the endpoint is an
+        EndpointPool, an endpoint is chosen from it and failed queries are
+        retried on the others.
+        '''
+        send = lambda endpoint: self._request(endpoint, terms, stream)
+        if isinstance(self.endpoint, EndpointPool):
+            return self.endpoint.request(send)
+        return send(self.endpoint)
+
+    def _request(self, endpoint, terms, stream=False):
+        '''
+        Send query terms to one endpoint. Long queries are sent with POST,
+        per `set_options(post_threshold=..., compress_posts=...)`.
+        '''
+        return self.transport.query(endpoint, terms, verify=self._verify_cert,
+                                    stream=stream,
+                                    post_threshold=_globals.get('post_threshold'),
+                                    compressed=_globals.get('compress_posts') or ())
+
+    def check_endpoints(self):
+        '''
+        Ask each endpoint in an EndpointPool for its fields, ejecting those
+        that fail and restoring those that answer. Returns {url: healthy}.
+        '''
+        if not isinstance(self.endpoint, EndpointPool):
+            raise TypeError("check_endpoints needs an EndpointPool endpoint")
+        terms = jsonlib.dumps(self._fields_query())
+        return self.endpoint.check(lambda endpoint: self._request(endpoint, terms))
+
+    def _from_cache(self, query):
+        ''' Return the cache key for a query and its cached response, if any. '''
+        cache = _globals.get('cache')
+        if cache is None:
+            return None, None
+        key = cache.key(self.endpoint, query)
+        return key, cache.get(key)
+
+    def _to_cache(self, key, response, query):
+        cache = _globals.get('cache')
+        # Don't hold on to server-side errors
+        if cache is not None and key is not None and not (
+                type(response) is dict and response.get('status') == 'error'):
+            cache.set(key, response)
+            if query.get('method') == 'data':
+                cache.index(self.endpoint, query, key)
         
 
 class BWResults:
+    # Compact dtypes for counts. 'uint' is uint32, or uint64 for big counts.
+    count_dtypes = {"TextCount": "uint",
+                    "WordCount": "uint",
+                    "WordsPerMillion": "float32",
+                    "TextPercent": "float32"}
+
+    # Group values that `drop_unknowns` removes. Set others for every
+    # database with `set_options(unknowns=[...])`, or for some databases
+    # with `set_options(unknowns={database: [...]})`.
+    unknowns = ["No place, unknown, or undetermined", "", " ", "Unknown",
+                "Unknown or not specified", "No attempt to code", "Undetermined",
+                "|||", "???", "N/A", "unk"]
 
     def __init__(self, results, query, dtypes={}):
         self._json = results
+        self.database = query.get('database')
         if type(query['groups']) is list:
             self.groups = query['groups']
         else:
@@ -271,46 +948,186 @@ class BWResults:
         
         # Results don't care about leading '*'
         self.groups = [g.lstrip("*") for g in self.groups]
+
+        # Columns for results built with from_rows rather than from JSON
+        self._rows = None
+        # The expanded, typed table, and the frames derived from it
+        self._table = None
+        self._views = {}
+
+    @classmethod
+    def from_rows(cls, rows, query, dtypes={}):
+        '''
+        Build results from `(group values, counts)` pairs, such as those from
+        BWQuery.iter_rows, rather than from nested JSON.
+        '''
+        results = cls(None, query, dtypes)
+        keys = [[] for g in results.groups]
+        counts = [[] for c in results.counttype]
+        for row_keys, row_counts in rows:
+            for column, k in zip(keys, row_keys):
+                column.append(k)
+            for column, c in zip(counts, row_counts):
+                column.append(c)
+        columns = dict(zip(results.groups,
+                           [np.array(k, dtype=object) for k in keys]))
+        columns.update(zip(results.counttype, [np.array(c) for c in counts]))
+        return cls.from_columns(columns, query, dtypes)
+
+    @classmethod
+    def from_columns(cls, columns, query, dtypes={}):
+        '''
+        Build results from a dict of arrays, one per group and counttype,
+        rather than from nested JSON.
+        '''
+        results = cls(None, query, dtypes)
+        results._rows = columns
+        return results
     
     def frame(self, index=True, drop_zeros=False, drop_unknowns=False):
-        df = pd.DataFrame(self.tolist())
-        
-        for k,v in self.dtypes.items():
-            if k in df:
-                if v == 'integer':
-                    df[k] = pd.to_numeric(df[k])
-                elif v == 'datetime':
-                    df[k] = pd.to_datetime(df[k])
-                #elif v == 'character':
-                #    df[k] = df[k].str.encode('utf8','replace')
-                    
-        # Drop unknown values
-        if drop_unknowns:
-            blacklist = ["No place, unknown, or undetermined", "", " ", "Unknown",
-             "Unknown or not specified", "No attempt to code", "Undetermined", "|||",
-             "???", "N/A", "unk"]
-            df = df[~df.T.isin(blacklist).any()]
-        
+        '''
+        Return the results as a DataFrame, sorted by count.
+
+        Frames are cached for each combination of arguments, and share one
+        expanded table, so repeated calls are cheap. Copy the frame before
+        modifying it in place. Use `clear_cache()` to free the memory.
+        '''
+        unknowns = tuple(self._unknowns()) if drop_unknowns else None
+        key = (index, drop_zeros, unknowns)
+        if key not in self._views:
+            timer = Timer()
+            self._views[key] = self._derive_frame(timer, *key)
+            _emit({'event': 'frame', 'phases': timer.phases,
+                   'rows': len(self._views[key])})
+        return self._views[key]
+
+    def clear_cache(self):
+        ''' Release the cached table and frames. '''
+        self._table = None
+        self._views = {}
+
+    def _base_table(self, timer):
+        if self._table is None:
+            columns = self._typed_columns(timer)
+            self._table = pd.DataFrame(columns, copy=False)
+            timer.lap('build')
+        return self._table
+
+    def _unknowns(self):
+        unknowns = _globals.get('unknowns')
+        if unknowns is None:
+            return self.unknowns
+        if isinstance(unknowns, dict):
+            return unknowns.get(self.database, self.unknowns)
+        return unknowns
+
+    def _derive_frame(self, timer, index, drop_zeros, unknowns):
+        df = self._base_table(timer)
+
+        # Rows to drop are found column by column and removed in one pass:
+        # unknown values are only looked for in the groups, and zeros in
+        # the counts.
+        drop = None
+        if unknowns is not None:
+            drop = self._unknown_rows(df, self.groups, unknowns)
+        if drop_zeros:
+            # Rows with zero for every count type
+            zeros = np.ones(len(df), dtype=bool)
+            for counttype in self.counttype:
+                zeros &= df[counttype].to_numpy() == 0
+            drop = zeros if drop is None else drop | zeros
+        if drop is not None:
+            df = df[~drop]
+            timer.lap('filter')
+
         # Set index
         if len(self.groups) > 0 and index:
             df2 = df.set_index(self.groups)
         else:
             df2 = df[self.groups + self.counttype]
-        
-        # Drop rows with zero for any count type
-        if drop_zeros:
-            df3 = df2[(df2.T != 0).any()].sort_values(self.counttype, ascending=False)
-        else:
-            df3 = df2.sort_values(self.counttype, ascending=False)
-        
+        timer.lap('index')
+
+        df3 = df2.sort_values(self.counttype, ascending=False)
+        timer.lap('sort')
+
         return df3
+
+    @staticmethod
+    def _unknown_rows(df, groups, unknowns):
+        '''
+        Return a boolean mask of the rows with an unknown value in any of the
+        groups. Categorical groups are checked once per category.
+        '''
+        mask = np.zeros(len(df), dtype=bool)
+        for group in groups:
+            column = df[group]
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                unknown = column.cat.categories.isin(unknowns)
+                if unknown.any():
+                    codes = column.cat.codes.to_numpy()
+                    # Code -1 is a missing value, not the last category
+                    mask |= unknown[codes] & (codes >= 0)
+            elif not (pd.api.types.is_numeric_dtype(column.dtype) or
+                      pd.api.types.is_datetime64_any_dtype(column.dtype)):
+                mask |= column.isin(unknowns).to_numpy()
+        return mask
+
+    def _typed_columns(self, timer):
+        '''
+        Return the expanded columns converted to the field types from the
+        server: numbers and dates for those field types, categoricals for
+        character fields, and the smallest safe dtypes for counts.
+        '''
+        columns = self._columns()
+        timer.lap('expand')
+        for k in self.groups:
+            v = self.dtypes.get(k)
+            if v is None and k.endswith('__id'):
+                v = 'integer'
+            if v == 'integer':
+                columns[k] = pd.to_numeric(columns[k])
+            elif v == 'datetime':
+                columns[k] = pd.to_datetime(columns[k])
+            elif v == 'character':
+                columns[k] = pd.Categorical(columns[k])
+
+        for k in self.counttype:
+            columns[k] = self._compact_counts(columns[k], self.count_dtypes.get(k))
+        timer.lap('coerce')
+        return columns
+
+    @staticmethod
+    def _compact_counts(values, dtype):
+        if dtype is None or len(values) == 0:
+            return values
+        if dtype == 'uint':
+            if values.dtype.kind not in 'iu' or values.min() < 0:
+                return values
+            dtype = np.uint32 if values.max() <= np.iinfo(np.uint32).max else np.uint64
+        elif values.dtype.kind not in 'iuf':
+            return values
+        return values.astype(dtype)
         
     def dataframe(self, **args):
         ''' Alias for frame '''
         return self.frame(**args)
     
     def json(self):
+        if self._json is None:
+            self._json = self._nest()
         return self._json
+
+    def _nest(self):
+        ''' Rebuild nested JSON for results built with from_rows. '''
+        if len(self.groups) == 0:
+            return [c for keys, counts in self._iter_leaves() for c in counts]
+        nested = {}
+        for keys, counts in self._iter_leaves():
+            d = nested
+            for k in keys[:-1]:
+                d = d.setdefault(k, {})
+            d[keys[-1]] = list(counts)
+        return nested
     
     def csv(self, **args):
         '''
@@ -321,30 +1138,463 @@ class BWResults:
         '''
         return self.dataframe(index=True).to_csv(**args)
     
+    def to_csv(self, path_or_buffer, chunksize=100000):
+        '''
+        Write the results as CSV to a path or file-like object, without
+        building a DataFrame. Rows are in the order the server returned them,
+        and memory use is bounded by chunksize rather than the result size.
+        Files opened from a path are written as UTF-8.
+        '''
+        if hasattr(path_or_buffer, 'write'):
+            f = path_or_buffer
+        else:
+            f = open(path_or_buffer, 'w', newline='', encoding='utf-8')
+        try:
+            writer = csv.writer(f)
+            writer.writerow(self.groups + self.counttype)
+            for chunk in self._iter_chunks(chunksize):
+                writer.writerows(zip(*chunk))
+        finally:
+            if f is not path_or_buffer:
+                f.close()
+
+    def to_arrow(self, chunksize=100000):
+        ''' Return the results as a pyarrow Table. '''
+        pa, pq = _import_pyarrow()
+        schema = self._arrow_schema()
+        return pa.Table.from_batches(list(self._iter_batches(schema, chunksize)),
+                                     schema=schema)
+
+    def to_parquet(self, path, chunksize=100000, **kwargs):
+        '''
+        Write the results to a Parquet file, one row group at a time, without
+        building a DataFrame. Extra arguments are passed to
+        pyarrow.parquet.ParquetWriter.
+        '''
+        pa, pq = _import_pyarrow()
+        schema = self._arrow_schema()
+        with pq.ParquetWriter(path, schema, **kwargs) as writer:
+            for batch in self._iter_batches(schema, chunksize):
+                writer.write_batch(batch)
+
+    def to_ndarray(self, sparse=False):
+        '''
+        Return the results as one array per counttype, with an axis for each
+        group, for slicing and aggregating with NumPy:
+
+            counts, axes = results.to_ndarray()
+            by_year = counts['WordCount'].sum(axis=1)
+
+        Returns a dict of arrays by counttype, and a dict of axis labels by
+        group: the distinct values of each group, sorted. Cells missing from
+        the results are zero.
+
+        sparse: Return `sparse.COO` arrays, from the pydata `sparse`
+            package, rather than dense ones. Worthwhile when most
+            combinations of group values have no results.
+        '''
+        df = self._base_table(Timer())
+        axes = {}
+        codes = []
+        for group in self.groups:
+            column = df[group]
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                labels = column.cat.categories.to_numpy()
+                code = column.cat.codes.to_numpy()
+            else:
+                labels, code = np.unique(column.to_numpy(), return_inverse=True)
+            axes[group] = labels
+            codes.append(code)
+        shape = tuple(len(labels) for labels in axes.values())
+
+        arrays = {}
+        for counttype in self.counttype:
+            values = df[counttype].to_numpy()
+            if len(self.groups) == 0:
+                arrays[counttype] = values.reshape(())
+            elif sparse:
+                arrays[counttype] = _import_sparse().COO(np.array(codes), values,
+                                                         shape=shape)
+            else:
+                arrays[counttype] = np.zeros(shape, dtype=values.dtype)
+                arrays[counttype][tuple(codes)] = values
+        return arrays, axes
+
+    def to_xarray(self, sparse=False):
+        '''
+        Return the results as an xarray Dataset, with a variable for each
+        counttype and a labelled dimension for each group. See `to_ndarray`.
+        '''
+        try:
+            import xarray as xr
+        except ImportError:
+            raise ImportError("xarray export requires xarray. Install it with "
+                              "`pip install xarray`.")
+        arrays, axes = self.to_ndarray(sparse=sparse)
+        dims = list(axes.keys())
+        return xr.Dataset({k: (dims, v) for k, v in arrays.items()}, coords=axes)
+
+    def _arrow_schema(self):
+        ''' Arrow types for each column, from the field types on the server. '''
+        pa, pq = _import_pyarrow()
+        group_types = {'integer': pa.int64(), 'datetime': pa.timestamp('s')}
+        count_types = {'uint': pa.uint64(), 'float32': pa.float32()}
+        fields = []
+        for k in self.groups:
+            v = self.dtypes.get(k)
+            if v is None and k.endswith('__id'):
+                v = 'integer'
+            fields.append(pa.field(k, group_types.get(v, pa.string())))
+        for k in self.counttype:
+            v = self.count_dtypes.get(k)
+            fields.append(pa.field(k, count_types.get(v, pa.float64())))
+        return pa.schema(fields)
+
+    def _iter_batches(self, schema, chunksize):
+        pa, pq = _import_pyarrow()
+        for chunk in self._iter_chunks(chunksize):
+            # Keys arrive as strings, so let Arrow parse numbers and dates
+            arrays = [pa.array(values, pa.string()).cast(field.type)
+                      if i < len(self.groups) else pa.array(values, field.type)
+                      for i, (field, values) in enumerate(zip(schema, chunk))]
+            yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def _iter_chunks(self, chunksize):
+        '''
+        Yield the results as lists of columns, up to chunksize rows at a time.
+        '''
+        chunk = [[] for name in self.groups + self.counttype]
+        for keys, counts in self._iter_leaves():
+            for column, value in zip(chunk, keys + tuple(counts)):
+                column.append(value)
+            if len(chunk[0]) >= chunksize:
+                yield chunk
+                chunk = [[] for column in chunk]
+        if len(chunk[0]) > 0:
+            yield chunk
+
+    def _iter_leaves(self):
+        '''
+        Walk the nested results depth-first without recursion, yielding a
+        tuple of group keys and the list of counts for each row.
+        '''
+        if self._rows is not None:
+            n = len(self._rows[self.counttype[0]])
+            keys = zip(*[self._rows[g].tolist() for g in self.groups])
+            counts = zip(*[self._rows[c].tolist() for c in self.counttype])
+            for row in zip(keys if self.groups else itertools.repeat((), n), counts):
+                yield row
+            return
+
+        depth = len(self.groups)
+        if depth == 0:
+            yield (), self._json
+            return
+        path = []
+        stack = [iter(self._json.items())]
+        while stack:
+            try:
+                k, v = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+                if path:
+                    path.pop()
+                continue
+            if len(stack) == depth:
+                yield tuple(path) + (k,), v
+            else:
+                path.append(k)
+                stack.append(iter(v.items()))
+
     def tuples(self):
         ''' Return a list of tuples '''
-        return [tuple(row) for row in self.dataframe(index=False).values]
+        return list(self.dataframe(index=False).itertuples(index=False, name=None))
     
     def tolist(self):
         ''' Return a list of key value pairs for each count'''
-        return self._expand(self._json, self.groups, self.counttype)
+        columns = self._columns()
+        names = list(columns.keys())
+        values = [columns[name].tolist() for name in names]
+        return [dict(zip(names, row)) for row in zip(*values)]
     
-    def _expand(self, o, grouplist, counttypes, collector=[]):
-        '''
-        A recursive method for exploding results into rows, one line per set of
-        facets
-        '''
-        new_coll = []
-        if len(grouplist) == 0:
-            l = []
-            for i, val in enumerate(o):
-                counttype = counttypes[i]
-                l += [(counttype, val)]
-            return [dict(collector + l)]
+    def _columns(self):
+        ''' Return a dict of columns, one per group and counttype. '''
+        if self._rows is not None:
+            return dict(self._rows)
+        return self._expand(self._json, self.groups, self.counttype)
+
+    def _expand(self, o, grouplist, counttypes):
+        '''
+        Explode results into columns: one per group, then one per counttype.
+
+        Rather than recursing and building a dict for every row, this walks
+        the results one level at a time, noting the parent of each node. The
+        keys for each level are then broadcast down to the rows with NumPy.
+        '''
+        nodes = [o]
+        keys = []
+        parents = []
+        for group in grouplist:
+            level_keys = []
+            children = []
+            sizes = []
+            for node in nodes:
+                level_keys.extend(node.keys())
+                children.extend(node.values())
+                sizes.append(len(node))
+            keys.append(np.array(level_keys, dtype=object))
+            parents.append(np.repeat(np.arange(len(nodes)), sizes))
+            nodes = children
+
+        # Walk back up from the rows, looking up each row's key at each level
+        group_columns = []
+        ancestor = np.arange(len(nodes))
+        for level_keys, parent in zip(reversed(keys), reversed(parents)):
+            group_columns.insert(0, level_keys[ancestor])
+            ancestor = parent[ancestor]
+
+        columns = dict(zip(grouplist, group_columns))
+        for i, counttype in enumerate(counttypes):
+            columns[counttype] = np.array([row[i] for row in nodes])
+        return columns
+
+
+_additive_counttypes = ["TextCount", "WordCount"]
+
+# Counttypes that are ratios of an additive count to the corpus total, with
+# the count and the scale
+_ratio_counttypes = {"WordsPerMillion": ("WordCount", 1e6),
+                     "TextPercent": ("TextCount", 100)}
+
+
+def _fill_range(lo, hi, values):
+    ''' Fill open bounds of a [low, high) range from the known values. '''
+    known = [int(v) for v in values]
+    lo = min(known) if lo is None else lo
+    hi = max(known) + 1 if hi is None else hi
+    return int(lo), int(hi)
+
+
+def _shard_step(done, merged, elapsed, depth, target_rows, target_seconds):
+    '''
+    The shard size that should give about target_rows rows or take about
+    target_seconds, from a first shard of size done.
+    '''
+    steps = []
+    if target_rows:
+        rows = _count_rows(merged, depth)
+        steps.append(done * target_rows / max(rows, 1))
+    if target_seconds:
+        steps.append(done * target_seconds / max(elapsed, 1e-3))
+    return max(1, int(min(steps)))
+
+
+def _count_rows(o, depth):
+    ''' Count the rows in nested results. '''
+    nodes = [o]
+    for i in range(depth):
+        nodes = [v for node in nodes for v in node.values()]
+    return len(nodes)
+
+
+def _merge_nested(a, b):
+    '''
+    Combine two nested results, summing the counts of rows found in both.
+    Neither input is modified.
+    '''
+    if type(a) is list:
+        return [x + y for x, y in zip(a, b)]
+    merged = dict(a)
+    for k, v in b.items():
+        merged[k] = _merge_nested(merged[k], v) if k in merged else v
+    return merged
+
+
+def _rollup(data, from_groups, from_counttypes, groups, counttypes):
+    '''
+    Sum nested results over the groups in from_groups that aren't in groups,
+    keeping the given counttypes. Returns new nested results, with the
+    groups in the order given.
+    '''
+    positions = [from_groups.index(g) for g in groups]
+    columns = [from_counttypes.index(c) for c in counttypes]
+    leaves = BWResults(data, {'groups': from_groups,
+                              'counttype': from_counttypes})._iter_leaves()
+    if not groups:
+        totals = [0] * len(columns)
+        for keys, counts in leaves:
+            for i, c in enumerate(columns):
+                totals[i] += counts[c]
+        return totals
+
+    rolled = {}
+    for keys, counts in leaves:
+        node = rolled
+        for p in positions[:-1]:
+            node = node.setdefault(keys[p], {})
+        leaf = node.get(keys[positions[-1]])
+        if leaf is None:
+            node[keys[positions[-1]]] = [counts[c] for c in columns]
         else:
-            l = []
-            for k, v in o.items():
-                item = (grouplist[0], k)
-                new_coll = collector + [item]
-                l += self._expand(v, grouplist[1:], counttypes, new_coll)
-            return l
+            for i, c in enumerate(columns):
+                leaf[i] += counts[c]
+    return rolled
+
+
+def _with_ratios(data, base, denominators, query, dtypes):
+    '''
+    Build BWResults for query from the results of base, its query for base
+    counts, computing the ratio counttypes against the nested denominators
+    (TextCount and WordCount totals, by the same groups).
+    '''
+    counts = BWResults(data, base)
+    columns = counts._columns()
+    rows = len(columns[counts.counttype[0]])
+
+    # Look up each row's totals by its group values; rows without any are NaN
+    totals = np.full((rows, 2), np.nan)
+    keys = zip(*[columns[g].tolist() for g in counts.groups]) if counts.groups \
+        else itertools.repeat((), rows)
+    for i, row_keys in enumerate(keys):
+        node = denominators
+        for k in row_keys:
+            node = node.get(k)
+            if node is None:
+                break
+        if node is not None:
+            totals[i] = node
+
+    results = {g: columns[g] for g in counts.groups}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for c in (query['counttype'] if type(query['counttype']) is list
+                  else [query['counttype']]):
+            if c not in _ratio_counttypes:
+                results[c] = columns[c]
+                continue
+            count, scale = _ratio_counttypes[c]
+            total = totals[:, 0 if count == 'TextCount' else 1]
+            results[c] = np.where(total > 0, columns[count] / total * scale, np.nan)
+    return BWResults.from_columns(results, query, dtypes)
+
+
+def _in_span(value, start, stop):
+    ''' Whether value is an integer in [start, stop); stop None is open. '''
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return False
+    return start <= value and (stop is None or value < stop)
+
+
+def _empty_refresh(start, stop, values):
+    ''' Whether there is nothing to refresh in [start, stop) of values. '''
+    if values is None:
+        return stop is not None and start >= stop
+    return not any(_in_span(v, start, stop) for v in values)
+
+
+def _splice(old, new, depth, replaced):
+    '''
+    Return a copy of nested results `old`, with the cells whose key at depth
+    is replaced(key) swapped for the cells of `new`. Branches left empty are
+    dropped. Neither input is modified.
+    '''
+    if depth == 0:
+        merged = {k: v for k, v in old.items() if not replaced(k)}
+        merged.update(new)
+        return merged
+    merged = {}
+    for k, v in old.items():
+        branch = _splice(v, new.get(k, {}), depth - 1, replaced)
+        if len(branch) > 0:
+            merged[k] = branch
+    for k, v in new.items():
+        if k not in merged:
+            merged[k] = v
+    return merged
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Arrow and Parquet export require pyarrow. Install "
+                          "it with `pip install pyarrow`.")
+    return pa, pq
+
+
+def _parse_rows(events, ngroups):
+    '''
+    Yield `(group values, counts)` rows from ijson.basic_parse events for a
+    Bookworm response, as they are parsed.
+    '''
+    parser = _RowParser(ngroups)
+    for event, value in events:
+        row = parser.feed(event, value)
+        if row is not None:
+            yield row
+    parser.close()
+
+
+class _RowParser:
+    '''
+    Reads rows from ijson.basic_parse events one at a time, so that the same
+    parsing serves both iterators and async iterators of events.
+    '''
+
+    def __init__(self, ngroups):
+        self.ngroups = ngroups
+        # The key currently being read in each open map. In the results, the
+        # first is 'data' and the rest are group values.
+        self.keys = []
+        self.counts = None
+        self.status, self.message = None, None
+
+    def feed(self, event, value):
+        ''' Take one event, returning the row it completes, if any. '''
+        keys = self.keys
+        if event == 'map_key':
+            keys[-1] = value
+        elif event == 'start_map':
+            keys.append(None)
+        elif event == 'end_map':
+            keys.pop()
+        elif event == 'start_array':
+            if len(keys) == self.ngroups + 1 and keys[0] == 'data':
+                self.counts = []
+        elif event == 'end_array':
+            if self.counts is not None:
+                row = tuple(keys[1:]), self.counts
+                self.counts = None
+                return row
+        elif self.counts is not None:
+            self.counts.append(value)
+        elif len(keys) == 1 and keys[0] == 'status':
+            self.status = value
+        elif len(keys) == 1 and keys[0] == 'message':
+            self.message = value
+        return None
+
+    def close(self):
+        ''' Raise if the response was an error. '''
+        if self.status == 'error':
+            raise ValueError("Bookworm returned an error: %s" % self.message)
+
+
+def _import_sparse():
+    try:
+        import sparse
+    except ImportError:
+        raise ImportError("Sparse arrays require the sparse package. Install "
+                          "it with `pip install sparse`.")
+    return sparse
+
+
+def _import_ijson():
+    try:
+        import ijson
+    except ImportError:
+        raise ImportError("Streaming requires ijson. Install it with "
+                          "`pip install ijson`.")
+    return ijson
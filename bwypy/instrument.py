@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+
+class Timer:
+    '''
+    Records how long each phase of some work took. Call `lap(name)` at the
+    end of each phase.
+    '''
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self._last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0) + now - self._last
+        self._last = now
+
+    def total(self):
+        return sum(self.phases.values())
+
+
+class TimingAggregator:
+    '''
+    Collects instrumentation events and summarizes the time spent in each
+    phase. Set it as an instrumentation hook:
+
+        timings = TimingAggregator()
+        bwypy.set_options(instrument=timings)
+        ...
+        print(timings.report())
+
+    Events are dicts with an 'event' name ('fetch' for server requests,
+    'frame' for building DataFrames) and a 'phases' dict of seconds, along
+    with details like 'bytes', 'rows' and 'cache' ('hit' or 'miss').
+    '''
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def clear(self):
+        with self._lock:
+            self.events = []
+
+    def summary(self, percentiles=(50, 95)):
+        '''
+        Return {(event, phase): {'count': n, 'p50': seconds, ...}}. The
+        'total' phase is the sum of the phases for each event.
+        '''
+        timings = defaultdict(list)
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            phases = event['phases']
+            for phase, seconds in phases.items():
+                timings[(event['event'], phase)].append(seconds)
+            timings[(event['event'], 'total')].append(sum(phases.values()))
+
+        summary = OrderedDict()
+        for key in sorted(timings):
+            values = sorted(timings[key])
+            stats = OrderedDict(count=len(values))
+            for p in percentiles:
+                stats['p%d' % p] = _percentile(values, p)
+            summary[key] = stats
+        return summary
+
+    def report(self, percentiles=(50, 95)):
+        ''' Return the summary as a table, in milliseconds. '''
+        names = ['p%d' % p for p in percentiles]
+        lines = ["%-8s %-12s %7s " % ("event", "phase", "count") +
+                 " ".join("%10s" % ("%s ms" % n) for n in names)]
+        for (event, phase), stats in self.summary(percentiles).items():
+            lines.append("%-8s %-12s %7d " % (event, phase, stats['count']) +
+                         " ".join("%10.2f" % (stats[n] * 1000) for n in names))
+        cache = [e['cache'] for e in self.events if e.get('cache')]
+        if cache:
+            lines.append("cache hits: %d of %d" % (cache.count('hit'), len(cache)))
+        return "\n".join(lines)
+
+
+def _percentile(values, p):
+    ''' Nearest-rank percentile of a sorted list. '''
+    if len(values) == 0:
+        return None
+    rank = int(round(p / 100. * (len(values) - 1)))
+    return values[rank]
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+
+
+class FieldRegistry:
+    '''
+    Field metadata shared by every BWQuery in a process, so that a new
+    BWQuery for an endpoint and database that were already seen doesn't ask
+    the server for its fields again.
+
+    Concurrent lookups of the same missing entry wait on a single fetch.
+    Set it with `set_options(field_registry=FieldRegistry(...))`; otherwise
+    a default registry, held in memory with no expiry, is used.
+
+    ttl: Seconds before an entry is fetched again. None means never.
+    path: A JSON file to persist entries to, so that new processes start
+        with the metadata already loaded.
+    '''
+
+    def __init__(self, ttl=None, path=None):
+        self.ttl = ttl
+        self.path = path
+        self._entries = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self._entries = {k: tuple(v) for k, v in json.load(f).items()}
+
+    @staticmethod
+    def key(endpoint, database, *parts):
+        return "|".join([str(endpoint), str(database)] + [str(p) for p in parts])
+
+    def lookup(self, key):
+        ''' Return the entry for key if it's present and fresh, else None. '''
+        with self._lock:
+            return self._lookup(key)
+
+    def get(self, key, fetch):
+        '''
+        Return the entry for key, calling fetch() to fill it if needed. If
+        another thread is already fetching it, wait for that instead.
+        '''
+        while True:
+            with self._lock:
+                value = self._lookup(key)
+                if value is not None:
+                    return value
+                event = self._pending.get(key)
+                owner = event is None
+                if owner:
+                    event = self._pending[key] = threading.Event()
+            if not owner:
+                # If the other fetch failed, the loop tries again
+                event.wait()
+                continue
+            try:
+                value = fetch()
+                self.set(key, value)
+                return value
+            finally:
+                with self._lock:
+                    del self._pending[key]
+                event.set()
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._save()
+
+    def invalidate(self, endpoint=None, database=None):
+        '''
+        Drop entries for an endpoint and database, or all of them if no
+        arguments are given.
+        '''
+        with self._lock:
+            if endpoint is None:
+                self._entries.clear()
+            else:
+                prefix = (self.key(endpoint, database) if database else str(endpoint)) + "|"
+                for key in [k for k in self._entries if k.startswith(prefix)]:
+                    del self._entries[key]
+            self._save()
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        fetched, value = entry
+        if self.ttl is not None and time.time() - fetched > self.ttl:
+            return None
+        return value
+
+    def _save(self):
+        if self.path is None:
+            return
+        # Write to a temporary file first, so readers never see half a file
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, self.path)
+
+
+_default = FieldRegistry()
+
+
+def default_registry():
+    ''' The registry used when none is set with set_options. '''
+    return _default
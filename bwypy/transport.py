@@ -0,0 +1,265 @@
+import gzip
+import logging
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HTTPTransport:
+    '''
+    Pooled HTTP connections to Bookworm servers.
+
+    One transport can be shared by every BWQuery in a process: connections to
+    the same host are kept alive and reused, rather than opening a new
+    TCP/TLS connection for each query.
+
+    pool_size: Maximum connections kept open per host.
+    timeout: Seconds to wait, either a single number or a
+        (connect, read) tuple.
+    retries: How many times to retry after connection errors or 5xx
+        responses.
+    backoff_factor: Retries wait backoff_factor * 2^(retry number) seconds.
+    '''
+    retry_statuses = [500, 502, 503, 504]
+    # Bookworm queries only read, so POSTs are as safe to retry as GETs
+    retry_methods = ['GET', 'POST']
+
+    def __init__(self, pool_size=10, timeout=(10, 600), retries=3,
+                 backoff_factor=0.5):
+        self.timeout = timeout
+        retry = Retry(total=retries, connect=retries, read=retries,
+                      status=retries, backoff_factor=backoff_factor,
+                      status_forcelist=self.retry_statuses,
+                      allowed_methods=self.retry_methods)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, verify=True, stream=False):
+        '''
+        Send a GET request and return the `requests` response. With stream,
+        the body is left to be read from `response.raw`.
+        '''
+        r = self.session.get(url, timeout=self.timeout, verify=verify,
+                             stream=stream)
+        r.raise_for_status()
+        return r
+
+    def post(self, url, data, headers=None, verify=True, stream=False):
+        ''' Send a POST request and return the `requests` response. '''
+        r = self.session.post(url, data=data, headers=headers,
+                              timeout=self.timeout, verify=verify, stream=stream)
+        r.raise_for_status()
+        return r
+
+    def query(self, endpoint, terms, verify=True, stream=False,
+              post_threshold=None, compressed=()):
+        '''
+        Send JSON query terms to a Bookworm endpoint, in the URL of a GET or,
+        if they are long, in the body of a POST. See `encode_query`.
+        '''
+        url, body, headers = encode_query(endpoint, terms, post_threshold, compressed)
+        if body is None:
+            return self.get(url, verify=verify, stream=stream)
+        return self.post(url, body, headers=headers, verify=verify, stream=stream)
+
+    def close(self):
+        self.session.close()
+
+
+# URL-encoded queries longer than this many characters are sent with POST
+POST_THRESHOLD = 2000
+
+def encode_query(endpoint, terms, post_threshold=None, compressed=()):
+    '''
+    Encode JSON query terms for an endpoint, returning `(url, body,
+    headers)`. body is None if the query fits in the URL of a GET; queries
+    longer than post_threshold characters (POST_THRESHOLD by default) go in
+    a form-encoded POST body instead, gzipped if the endpoint is one of
+    `compressed`.
+
+    Compression is opt-in for each endpoint because there is no reliable way
+    to tell that a server can't read a compressed body: a CGI script may
+    fail with a 500, or answer with an error, rather than a 415.
+    '''
+    params = urlencode({'queryTerms': terms})
+    if post_threshold is None:
+        post_threshold = POST_THRESHOLD
+    if len(params) <= post_threshold:
+        return "%s?%s" % (endpoint, params), None, {}
+    body = params.encode('ascii')
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    if endpoint in compressed:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    return endpoint, body, headers
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_transport():
+    ''' The transport shared by queries that weren't given one. '''
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = HTTPTransport()
+        return _default
+
+
+class EndpointPool:
+    '''
+    Several equivalent Bookworm endpoints, such as mirrors of one database,
+    to spread queries over. Pass it, or just a list of URLs, as the endpoint
+    of a BWQuery.
+
+    Queries that fail with a connection error or a 5xx response are retried
+    on the next endpoint. After max_failures failures in a row, an endpoint
+    is ejected for `cooldown` seconds, then given another chance.
+
+    policy: How to choose an endpoint for each query:
+        'round_robin': Take turns.
+        'least_outstanding': The one with the fewest queries in flight.
+        'latency': The fastest, by a moving average of response times.
+    '''
+    policies = ['round_robin', 'least_outstanding', 'latency']
+
+    def __init__(self, urls, policy='round_robin', max_failures=3, cooldown=30,
+                 alpha=0.3):
+        if policy not in self.policies:
+            raise ValueError("policy must be one of %s" % ", ".join(self.policies))
+        self.urls = list(urls)
+        self.policy = policy
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.outstanding = dict((url, 0) for url in self.urls)
+        self.latency = dict((url, None) for url in self.urls)
+        self.failures = dict((url, 0) for url in self.urls)
+        self.ejected = {}
+        self._turn = 0
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        # Mirrors are interchangeable, so they share cache entries
+        return "|".join(sorted(self.urls))
+
+    def candidates(self):
+        ''' Return the endpoints to try, in order of preference. '''
+        with self._lock:
+            now = time.time()
+            for url, since in list(self.ejected.items()):
+                if now - since > self.cooldown:
+                    del self.ejected[url]
+            healthy = [url for url in self.urls if url not in self.ejected]
+            self._turn += 1
+            n = len(healthy)
+            healthy = [healthy[(self._turn + i) % n] for i in range(n)]
+            if self.policy == 'least_outstanding':
+                healthy.sort(key=lambda url: self.outstanding[url])
+            elif self.policy == 'latency':
+                # Untried endpoints go first, so that they get measured
+                healthy.sort(key=lambda url: self.latency[url] or 0)
+            # Ejected endpoints are a last resort
+            return healthy + sorted(self.ejected, key=self.ejected.get)
+
+    def start(self, url):
+        with self._lock:
+            self.outstanding[url] += 1
+
+    def finish(self, url, seconds=None, failed=False):
+        '''
+        Record the end of a query to url. failed is None if it ended without
+        saying anything about the endpoint, e.g. because it was cancelled.
+        '''
+        with self._lock:
+            self.outstanding[url] -= 1
+            if failed is None:
+                return
+            if failed:
+                self.failures[url] += 1
+                if self.failures[url] >= self.max_failures:
+                    self.ejected[url] = time.time()
+                return
+            self.failures[url] = 0
+            self.ejected.pop(url, None)
+            if seconds is not None:
+                last = self.latency[url]
+                self.latency[url] = seconds if last is None else (
+                    self.alpha * seconds + (1 - self.alpha) * last)
+
+    def request(self, send):
+        '''
+        Call send(url) on each candidate endpoint until one succeeds, and
+        return its result.
+        '''
+        error = None
+        for url in self.candidates():
+            self.start(url)
+            start = time.time()
+            seconds, failed = None, None
+            try:
+                result = send(url)
+                seconds, failed = time.time() - start, False
+                return result
+            except requests.RequestException as e:
+                failed = _is_server_failure(e)
+                if not failed:
+                    raise
+                logging.warning("Query to %s failed, trying another endpoint: %s" % (url, e))
+                error = e
+            finally:
+                # Always runs, so that outstanding counts stay right
+                self.finish(url, seconds, failed)
+        raise error
+
+    def check(self, send):
+        '''
+        Actively check every endpoint with send(url), ejecting those that
+        fail and restoring those that succeed. Returns {url: healthy}.
+        '''
+        healthy = {}
+        for url in self.urls:
+            self.start(url)
+            start = time.time()
+            seconds, failed = None, None
+            try:
+                send(url)
+                seconds, failed = time.time() - start, False
+            except requests.RequestException:
+                failed = True
+                with self._lock:
+                    self.ejected[url] = time.time()
+            finally:
+                self.finish(url, seconds, failed)
+            healthy[url] = not failed
+        return healthy
+
+
+def _is_server_failure(e):
+    ''' Whether an error could go away on another endpoint. '''
+    response = getattr(e, 'response', None)
+    return response is None or response.status_code >= 500
+
+
+_pools = {}
+
+
+def endpoint_pool(urls):
+    '''
+    Return a shared EndpointPool for a list of URLs, so that every BWQuery
+    given the same list shares one set of health and latency stats.
+    '''
+    key = tuple(urls)
+    with _default_lock:
+        if key not in _pools:
+            _pools[key] = EndpointPool(urls)
+        return _pools[key]
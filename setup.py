@@ -11,5 +11,8 @@ setup(name='bwypy',
       keywords='hathitrust text-mining text-analysis bookworm',
       license='NCSA',
       packages=find_packages(),
-      install_requires=['pandas', "ujson"]
+      install_requires=['pandas', "ujson", "requests"],
+      extras_require={'async': ["aiohttp"], 'arrow': ["pyarrow"],
+                      'stream': ["ijson"], 'sparse': ["sparse"],
+                      'xarray': ["xarray"]}
       )
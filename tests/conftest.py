@@ -0,0 +1,12 @@
+import pytest
+
+from benchmarks.mockserver import MockBookworm
+
+
+@pytest.fixture
+def mock():
+    ''' A MockBookworm with date_year 1800-1804 and field0. '''
+    server = MockBookworm(cardinality=5, nfields=1)
+    server.start()
+    yield server
+    server.stop()
@@ -0,0 +1,48 @@
+import bwypy
+import bwypy.cache
+
+
+def test_cache_hits_are_copies(mock):
+    bw = bwypy.BWQuery(endpoint=mock.endpoint, database='mock')
+    bw.groups = ['date_year']
+    with bwypy.set_options(cache=bwypy.QueryCache()):
+        first = bw.run().json()
+        expected = dict(first)
+        first['1800'] = 'changed'
+        second = bw.run().json()
+        assert second == expected
+        second.clear()
+        assert bw.run().json() == expected
+
+
+def test_lru_eviction():
+    cache = bwypy.QueryCache(maxsize=2)
+    cache.set('a', {'data': 1})
+    cache.set('b', {'data': 2})
+    cache.get('a')
+    cache.set('c', {'data': 3})
+    assert cache.get('b') is None
+    assert cache.get('a') == {'data': 1}
+    assert cache.get('c') == {'data': 3}
+    assert len(cache) == 2
+
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bwypy.cache.time, 'time', lambda: now[0])
+    cache = bwypy.QueryCache(ttl=60)
+    cache.set('a', {'data': 1})
+    now[0] += 59
+    assert cache.get('a') == {'data': 1}
+    now[0] += 2
+    assert cache.get('a') is None
+
+
+def test_sqlite_round_trip(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = bwypy.QueryCache(path=path)
+    key = cache.key('http://a', {'database': 'mock', 'groups': ['date_year']})
+    cache.set(key, {'status': 'success', 'data': {'1800': [1, 2]}})
+    other = bwypy.QueryCache(path=path)
+    assert other.get(key) == {'status': 'success', 'data': {'1800': [1, 2]}}
+    assert other.stats() == {'hits': 1, 'misses': 0, 'size': 1}
@@ -0,0 +1,57 @@
+import asyncio
+import gzip
+import json
+from urllib.parse import parse_qs
+
+import aiohttp
+import pytest
+
+import bwypy
+from benchmarks.mockserver import MockBookworm
+from bwypy.transport import encode_query
+
+
+def test_pool_releases_endpoint_on_unexpected_error():
+    pool = bwypy.EndpointPool(['http://a', 'http://b'])
+
+    def send(url):
+        raise ValueError("not a request error")
+
+    with pytest.raises(ValueError):
+        pool.request(send)
+    assert pool.outstanding == {'http://a': 0, 'http://b': 0}
+
+
+def test_async_timeout_fails_over(mock):
+    slow = MockBookworm(cardinality=5, nfields=1, latency=1)
+    slow.start()
+    pool = bwypy.EndpointPool([slow.endpoint, mock.endpoint], policy='round_robin')
+
+    async def run():
+        timeout = aiohttp.ClientTimeout(total=0.3)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            bw = bwypy.AsyncBWQuery(endpoint=pool, database='mock', session=session,
+                                    verify_fields=False)
+            bw.groups = ['date_year']
+            return [await bw.run() for i in range(2)]
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        slow.stop()
+    assert all(len(r.json()) == 5 for r in results)
+    assert pool.outstanding == {slow.endpoint: 0, mock.endpoint: 0}
+    assert pool.failures[slow.endpoint] == 1
+
+
+def test_posts_compressed_only_for_listed_endpoints():
+    query = {'search_limits': {'word': ['naïve', 'café&co', 'a+b', 'Straße'] * 100}}
+    terms = json.dumps(query)
+    url, body, headers = encode_query('http://a', terms, compressed=['http://b'])
+    assert url == 'http://a'
+    assert 'Content-Encoding' not in headers
+    assert json.loads(parse_qs(body.decode('ascii'))['queryTerms'][0]) == query
+    url, body, headers = encode_query('http://b', terms, compressed=['http://b'])
+    assert headers['Content-Encoding'] == 'gzip'
+    form = parse_qs(gzip.decompress(body).decode('ascii'))
+    assert json.loads(form['queryTerms'][0]) == query
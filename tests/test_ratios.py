@@ -0,0 +1,36 @@
+import math
+
+import pytest
+
+import bwypy
+from bwypy.core import _with_ratios
+
+
+def test_with_ratios():
+    query = {'groups': ['date_year'], 'counttype': ['WordsPerMillion', 'TextPercent'],
+             'search_limits': {'word': ['whale']}}
+    base = dict(query, counttype=['WordCount', 'TextCount'])
+    data = {'1850': [20, 5], '1851': [3, 1], '1852': [7, 2]}
+    # TextCount and WordCount totals; 1851 has none, and 1852 is missing
+    denominators = {'1850': [50, 2000000], '1851': [0, 0]}
+    results = _with_ratios(data, base, denominators, query, {})
+    ratios = results.json()
+    assert ratios['1850'] == [10.0, 10.0]
+    assert all(math.isnan(v) for v in ratios['1851'])
+    assert all(math.isnan(v) for v in ratios['1852'])
+
+
+def test_local_ratios_skip_starred_groups():
+    bw = bwypy.BWQuery(endpoint='http://localhost', database='mock', verify_fields=False)
+    bw.counttype = ['WordsPerMillion']
+    bw.groups = ['date_year']
+    assert bw._ratio_counttypes() == ['WordsPerMillion']
+    bw.groups = ['*date_year']
+    assert bw._ratio_counttypes() == []
+
+
+def test_local_ratios_cant_stream():
+    bw = bwypy.BWQuery(endpoint='http://localhost', database='mock', verify_fields=False)
+    bw.counttype = ['WordsPerMillion']
+    with pytest.raises(ValueError):
+        bw.run(stream=True, local_ratios=True)
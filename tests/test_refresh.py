@@ -0,0 +1,53 @@
+import asyncio
+
+import bwypy
+
+
+def rows(results):
+    return sorted(t[:2] for t in results.tuples())
+
+
+def test_refresh_splices_into_cached_results(mock):
+    bw = bwypy.BWQuery(endpoint=mock.endpoint, database='mock')
+    bw.groups = ['date_year', 'field0']
+    with bwypy.set_options(cache=bwypy.QueryCache()):
+        full = bw.run()
+        assert rows(bw.refresh(1802)) == rows(full)
+
+
+def test_async_refresh(mock):
+    async def run():
+        async with bwypy.AsyncBWQuery(endpoint=mock.endpoint, database='mock') as bw:
+            bw.groups = ['date_year', 'field0']
+            # With nothing cached, the whole query is run
+            full = await bw.refresh(1802)
+            with bwypy.set_options(cache=bwypy.QueryCache()):
+                await bw.run()
+                refreshed = await bw.refresh(1802)
+            return full, refreshed
+    full, refreshed = asyncio.run(run())
+    assert rows(refreshed) == rows(full)
+
+
+def test_refresh_keeps_list_limits(mock):
+    bw = bwypy.BWQuery(endpoint=mock.endpoint, database='mock')
+    bw.groups = ['date_year']
+    bw.search_limits = {'date_year': ['1801', '1803']}
+    with bwypy.set_options(cache=bwypy.QueryCache()):
+        bw.run()
+        assert sorted(bw.refresh(1800).json()) == ['1801', '1803']
+        assert sorted(bw.refresh(1802).json()) == ['1801', '1803']
+        # Nothing listed in the span, so nothing to re-run
+        assert sorted(bw.refresh(1804).json()) == ['1801', '1803']
+        assert sorted(bw.run().json()) == ['1801', '1803']
+
+
+def test_async_refresh_keeps_list_limits(mock):
+    async def run():
+        async with bwypy.AsyncBWQuery(endpoint=mock.endpoint, database='mock') as bw:
+            bw.groups = ['date_year']
+            bw.search_limits = {'date_year': ['1801', '1803']}
+            with bwypy.set_options(cache=bwypy.QueryCache()):
+                await bw.run()
+                return (await bw.refresh(1800)).json()
+    assert sorted(asyncio.run(run())) == ['1801', '1803']
@@ -0,0 +1,32 @@
+import numpy as np
+
+import bwypy
+
+
+def test_to_ndarray_reuses_table():
+    results = bwypy.BWResults({'eng': {'1800': [1, 2], '1801': [3, 4]},
+                               'fre': {'1801': [5, 6]}},
+                              {'groups': ['language', 'date_year'],
+                               'counttype': ['WordCount', 'TextCount']})
+    calls = []
+    expand = results._typed_columns
+    results._typed_columns = lambda timer: calls.append(1) or expand(timer)
+    results.frame()
+    arrays, axes = results.to_ndarray()
+    assert len(calls) == 1
+    assert list(axes['language']) == ['eng', 'fre']
+    assert arrays['WordCount'].tolist() == [[1, 3], [0, 5]]
+    sparse_arrays, _ = results.to_ndarray(sparse=True)
+    assert np.array_equal(sparse_arrays['TextCount'].todense(), arrays['TextCount'])
+
+
+def test_to_csv_writes_utf8(tmp_path):
+    results = bwypy.BWResults({'Société Générale': [1, 2], 'Ōsaka Shoten': [3, 4]},
+                              {'groups': ['publisher'],
+                               'counttype': ['WordCount', 'TextCount']})
+    path = tmp_path / 'results.csv'
+    results.to_csv(str(path))
+    assert path.read_bytes().decode('utf-8').splitlines() == [
+        'publisher,WordCount,TextCount',
+        'Société Générale,1,2',
+        'Ōsaka Shoten,3,4']
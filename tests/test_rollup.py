@@ -0,0 +1,72 @@
+import threading
+
+import bwypy
+from benchmarks.mockserver import MockBookworm
+
+
+def query(endpoint, groups):
+    bw = bwypy.BWQuery(endpoint=endpoint, database='mock', verify_fields=False)
+    bw.groups = groups
+    bw.counttype = ['TextCount', 'WordCount']
+    return bw
+
+
+def by_year(nested):
+    return {year: [sum(counts[i] for counts in cells.values()) for i in range(2)]
+            for year, cells in nested.items()}
+
+
+def test_rollup_from_cached_result(mock):
+    with bwypy.set_options(cache=bwypy.QueryCache(), rollup=True):
+        wide = query(mock.endpoint, ['date_year', 'field0']).run().json()
+        requests = mock.requests
+        assert query(mock.endpoint, ['date_year']).run().json() == by_year(wide)
+        flipped = query(mock.endpoint, ['field0', 'date_year']).run().json()
+        assert flipped['value1']['1802'] == wide['1802']['value1']
+        total = query(mock.endpoint, []).run().json()
+        assert total == [sum(c[i] for c in by_year(wide).values()) for i in range(2)]
+        assert mock.requests == requests
+
+
+def test_rollup_uses_smallest_superset(mock):
+    with bwypy.set_options(cache=bwypy.QueryCache(), rollup=True):
+        query(mock.endpoint, ['date_year', 'field0', 'field1']).run()
+        wide = query(mock.endpoint, ['date_year', 'field0']).run().json()
+        assert query(mock.endpoint, ['date_year']).run().json() == by_year(wide)
+
+
+def run_together(bw, count=2):
+    ''' Run bw from several threads at once, returning results or errors. '''
+    outcomes = [None] * count
+
+    def run(i):
+        try:
+            outcomes[i] = bw.run().json()
+        except Exception as e:
+            outcomes[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def test_identical_queries_in_flight_share_a_request():
+    with MockBookworm(cardinality=5, nfields=1, latency=0.5) as server:
+        first, second = run_together(query(server.endpoint, ['date_year']))
+        assert server.requests == 1
+        assert first == second
+
+
+class BrokenBookworm(MockBookworm):
+    def respond(self, query):
+        self.requests += 1
+        return b'not json'
+
+
+def test_identical_queries_in_flight_share_an_error():
+    with BrokenBookworm(cardinality=5, nfields=1, latency=0.5) as server:
+        outcomes = run_together(query(server.endpoint, ['date_year']))
+        assert server.requests == 1
+        assert all(isinstance(e, ValueError) for e in outcomes)
@@ -0,0 +1,35 @@
+import asyncio
+
+import bwypy
+
+
+def test_run_sharded_keeps_list_limits(mock):
+    bw = bwypy.BWQuery(endpoint=mock.endpoint, database='mock')
+    bw.groups = ['date_year']
+    bw.search_limits = {'date_year': ['1801', '1802']}
+    assert sorted(bw.run().json()) == ['1801', '1802']
+    # MockBookworm's counts vary by query, so only the rows are compared
+    assert sorted(bw.run_sharded('date_year', step=1).json()) == ['1801', '1802']
+
+
+def test_run_sharded_splits_integer_range(mock):
+    bw = bwypy.BWQuery(endpoint=mock.endpoint, database='mock')
+    bw.groups = ['date_year', 'field0']
+    sharded = bw.run_sharded('date_year', step=2)
+    rows = lambda results: sorted(t[:2] for t in results.tuples())
+    assert rows(sharded) == rows(bw.run())
+
+
+def test_async_run_sharded(mock):
+    async def run():
+        async with bwypy.AsyncBWQuery(endpoint=mock.endpoint, database='mock') as bw:
+            bw.groups = ['date_year']
+            full = sorted((await bw.run()).json())
+            sharded = sorted((await bw.run_sharded('date_year', step=2)).json())
+            bw.search_limits = {'date_year': ['1803']}
+            listed = (await bw.run_sharded('date_year')).json()
+        return full, sharded, listed
+
+    full, sharded, listed = asyncio.run(run())
+    assert sharded == full
+    assert list(listed) == ['1803']
@@ -0,0 +1,39 @@
+import asyncio
+
+import bwypy
+
+
+def rows(results):
+    return sorted(t[:2] for t in results.tuples())
+
+
+def test_stream_matches_run(mock):
+    bw = bwypy.BWQuery(endpoint=mock.endpoint, database='mock')
+    bw.groups = ['date_year', 'field0']
+    assert rows(bw.run(stream=True)) == rows(bw.run())
+
+
+def test_async_stream(mock):
+    async def run():
+        async with bwypy.AsyncBWQuery(endpoint=mock.endpoint, database='mock') as bw:
+            bw.groups = ['date_year', 'field0']
+            full = await bw.run()
+            streamed = await bw.run(stream=True)
+            keys = [keys async for keys, counts in bw.iter_rows()]
+            return full, streamed, keys
+    full, streamed, keys = asyncio.run(run())
+    assert rows(streamed) == rows(full)
+    nested = full.json()
+    assert sorted(keys) == sorted((y, f) for y in nested for f in nested[y])
+
+
+def test_async_stream_from_pool(mock):
+    async def run():
+        pool = bwypy.EndpointPool([mock.endpoint])
+        async with bwypy.AsyncBWQuery(endpoint=pool, database='mock') as bw:
+            bw.groups = ['date_year']
+            streamed = await bw.run(stream=True)
+            return pool, streamed
+    pool, streamed = asyncio.run(run())
+    assert sorted(streamed.json()) == mock.values['date_year']
+    assert pool.outstanding == {mock.endpoint: 0}
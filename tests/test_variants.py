@@ -0,0 +1,24 @@
+import asyncio
+
+import bwypy
+
+
+def test_variant_field_values_stay_separate(mock):
+    bw = bwypy.BWQuery(endpoint=mock.endpoint, database='mock')
+    everything = bw.field_values('date_year')
+    variant = bw.with_limits({'date_year': ['1801', '1802']})
+    variant.limited_field_values('date_year')
+    assert sorted(variant.field_values('date_year')) == ['1801', '1802']
+    assert list(bw.field_values('date_year')) == list(everything)
+
+
+def test_async_variant_borrows_parent_session(mock):
+    async def run():
+        async with bwypy.AsyncBWQuery(endpoint=mock.endpoint, database='mock') as bw:
+            bw.groups = ['date_year']
+            variant = bw.with_limits({'date_year': ['1801']})
+            assert list((await variant.run()).json()) == ['1801']
+            return bw._session, variant._session
+    session, borrowed = asyncio.run(run())
+    assert borrowed is session
+    assert session.closed